@@ -0,0 +1,229 @@
+import os
+import pickle
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from src import DEFAULT
+
+
+def get_nbytes(data) -> int:
+    """
+    get the memory used by data, memory-mapped arrays are not counted
+    as they can be paged out by the system
+
+    """
+    if isinstance(data, np.memmap):
+        return 0
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    return sys.getsizeof(data)
+
+
+class LoadCache:
+    """
+    thread-safe LRU cache of loaded data, shared by the whole process
+
+    Entries are keyed by the path, modification time and size of the file
+    and by the loading options, so a modified file is loaded again.
+    Cached arrays are set read-only since they are shared between callers.
+
+    Parameters
+    ----------
+    max_bytes: int
+        memory budget, least recently used entries are evicted above it
+
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(path: str, files: list[str] = None, **options) -> tuple:
+        """
+        build the cache key of a file loaded with options
+
+        Parameters
+        ----------
+        path: str
+        files: list of str, default=None
+            files read to load path (e.g. images of a directory),
+            if None, only path is read
+        options: load options
+
+        """
+        stats = [os.stat(f) for f in files or [path]]
+        return (
+            os.path.abspath(path),
+            (len(stats), max(s.st_mtime_ns for s in stats)),
+            sum(s.st_size for s in stats),
+            tuple(sorted(options.items())),
+        )
+
+    def get(self, key: tuple):
+        """
+        get cached data, None if not cached
+        """
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key: tuple, data):
+        """
+        cache data if it is an array or a string and fits in the budget
+        """
+        if isinstance(data, np.ndarray):
+            data.flags.writeable = False
+        elif not isinstance(data, str):
+            return
+        nbytes = get_nbytes(data)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            # remove the entries of previous versions of the file
+            for k in [k for k in self._items if k[0] == key[0] and k[3] == key[3]]:
+                self.nbytes -= self._items.pop(k)[1]
+            self._items[key] = (data, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.nbytes -= evicted
+
+    def holds(self, data) -> bool:
+        """
+        True if data is a cached object
+        """
+        with self._lock:
+            return any(item is data for item, _ in self._items.values())
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+
+class ResultCache:
+    """
+    thread-safe cache of module results in a directory, kept between sessions
+
+    Entries are keyed by a fingerprint of the module type, parameters and
+    inputs. Numeric arrays are stored as .npy files and read back
+    memory-mapped (read-only), other results are pickled. Least recently
+    used entries are removed when the directory exceeds its budget.
+
+    Parameters
+    ----------
+    directory: str
+    max_bytes: int
+        disk budget
+
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, key: str, data=None) -> str:
+        """
+        get the file of an entry, the extension depends on data
+        if data is None, return the existing file or None
+        """
+        path = os.path.join(self.directory, key)
+        if data is None:
+            for ext in [".npy", ".pkl"]:
+                if os.path.isfile(path + ext):
+                    return path + ext
+            return None
+        if isinstance(data, np.ndarray) and not data.dtype.hasobject:
+            return path + ".npy"
+        return path + ".pkl"
+
+    def get(self, key: str):
+        """
+        get a cached result, None if not cached or unreadable
+        """
+        with self._lock:
+            path = self.get_path(key)
+            if path is None:
+                return None
+            try:
+                if path.endswith(".npy"):
+                    data = np.load(path, mmap_mode="r", allow_pickle=False)
+                else:
+                    with open(path, "rb") as f:
+                        data = pickle.load(f)
+            except Exception:
+                os.remove(path)
+                return None
+            # the modification time orders the entries by last use
+            os.utime(path)
+            return data
+
+    def put(self, key: str, data):
+        """
+        cache a result if it is not an exception and fits in the budget
+        """
+        if data is None or isinstance(data, Exception):
+            return
+        if get_nbytes(data) > self.max_bytes:
+            return
+        path = self.get_path(key, data)
+        # write in a temporary file so that a partial entry is never read
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with self._lock:
+            try:
+                if path.endswith(".npy"):
+                    with open(tmp_path, "wb") as f:
+                        np.save(f, data, allow_pickle=False)
+                else:
+                    with open(tmp_path, "wb") as f:
+                        pickle.dump(data, f)
+                os.replace(tmp_path, path)
+            except Exception:
+                if os.path.isfile(tmp_path):
+                    os.remove(tmp_path)
+                return
+            self.evict()
+
+    def evict(self):
+        """
+        remove least recently used entries until the directory fits the budget
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        nbytes = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if nbytes <= self.max_bytes:
+                break
+            os.remove(path)
+            nbytes -= size
+
+    def clear(self):
+        with self._lock:
+            for entry in os.scandir(self.directory):
+                if entry.is_file():
+                    os.remove(entry.path)
+
+
+# shared by every Load module of every graph
+LOAD_CACHE = LoadCache(DEFAULT.get("load_cache_size", 1024) * 2**20)
+
+# results of the modules of every graph, if a cache directory is set
+RESULT_CACHE = None
+if DEFAULT.get("result_cache_dir"):
+    RESULT_CACHE = ResultCache(
+        os.path.abspath(DEFAULT["result_cache_dir"]),
+        DEFAULT.get("result_cache_size", 4096) * 2**20,
+    )
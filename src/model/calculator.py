@@ -0,0 +1,294 @@
+import functools
+import operator
+import re
+
+import numpy as np
+
+from src.model import dtypes, parallel
+
+# binary operators by increasing priority
+PRIORITIES = [{"+": "add", "-": "subtract"}, {"x": "multiply", "÷": "divide"}]
+FUNCTIONS = {
+    "add": np.add,
+    "subtract": np.subtract,
+    "multiply": np.multiply,
+    "divide": np.divide,
+}
+TOKEN = re.compile(r"\s*(?:(\d+(?:[.,]\d*)?|[.,]\d+)|\[([^\]]*)\]|([-+x÷()]))")
+
+
+def tokenize(formula: str) -> list[tuple]:
+    """
+    split a formula into tokens
+
+    Return
+    ------
+    tokens: list of tuple
+        ("number", float), ("element", name) or ("sign", str)
+
+    """
+    tokens, position = [], 0
+    formula = formula.rstrip()
+    while position < len(formula):
+        match = TOKEN.match(formula, position)
+        if match is None:
+            raise ValueError(
+                "invalid formula '{}' at '{}'".format(formula, formula[position:])
+            )
+        number, name, sign = match.groups()
+        if number is not None:
+            tokens.append(("number", float(number.replace(",", "."))))
+        elif name is not None:
+            tokens.append(("element", name))
+        else:
+            tokens.append(("sign", sign))
+        position = match.end()
+    return tokens
+
+
+def parse(formula: str) -> tuple:
+    """
+    compile a formula into an expression tree, with usual operator priorities
+    (x and ÷ before + and -, from left to right), parenthesis and minus signs
+
+    Parameters
+    ----------
+    formula: str
+        e.g. "(3 x [Load_1] + 4 x [Load_2]) ÷ [Load_3]",
+        commas can be used as decimal separators
+
+    Return
+    ------
+    tree: tuple
+        ("constant", value), ("element", name) or (operation, left, right)
+        with operation in {'add', 'subtract', 'multiply', 'divide'}
+
+    """
+    tokens = tokenize(formula)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else (None, None)
+
+    def parse_binary(level):
+        nonlocal position
+        if level == len(PRIORITIES):
+            return parse_unary()
+        tree = parse_binary(level + 1)
+        while peek()[0] == "sign" and peek()[1] in PRIORITIES[level]:
+            operation = PRIORITIES[level][peek()[1]]
+            position += 1
+            tree = (operation, tree, parse_binary(level + 1))
+        return tree
+
+    def parse_unary():
+        nonlocal position
+        kind, value = peek()
+        position += 1
+        if (kind, value) == ("sign", "-"):
+            return ("multiply", ("constant", -1), parse_unary())
+        if (kind, value) == ("sign", "+"):
+            return parse_unary()
+        if (kind, value) == ("sign", "("):
+            tree = parse_binary(0)
+            if peek() != ("sign", ")"):
+                raise ValueError("missing ')' in formula '{}'".format(formula))
+            position += 1
+            return tree
+        if kind == "number":
+            return ("constant", int(value) if value.is_integer() else value)
+        if kind == "element":
+            return ("element", value)
+        raise ValueError("incomplete formula '{}'".format(formula))
+
+    tree = parse_binary(0)
+    if position != len(tokens):
+        raise ValueError("unexpected '{}' in formula '{}'".format(peek()[1], formula))
+    return tree
+
+
+def fold(operation: str, left, right):
+    """
+    compute an operation between two constants, integers stay exact and
+    other values are computed with float64
+    """
+    if isinstance(left, int) and isinstance(right, int) and operation != "divide":
+        function = {"add": operator.add, "subtract": operator.sub}.get(
+            operation, operator.mul
+        )
+        return function(left, right)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        value = float(FUNCTIONS[operation](np.float64(left), np.float64(right)))
+    return int(value) if value.is_integer() else value
+
+
+@functools.lru_cache(maxsize=128)
+def compile_formula(formula: str) -> tuple:
+    """
+    parse and optimize a formula, the result is cached by formula string.
+
+    - operations between constants are replaced by their result
+    - operands of additions and multiplications are sorted, so that
+      [A] x [B] and [B] x [A] are the same subexpression
+    - identical subexpressions are the same object, evaluate computes
+      them once per block
+
+    Parameters
+    ----------
+    formula: str
+        see parse
+
+    Return
+    ------
+    tree: tuple
+        see parse, must not be modified
+
+    """
+    nodes = {}
+
+    def optimize(node):
+        if node[0] in FUNCTIONS:
+            left, right = optimize(node[1]), optimize(node[2])
+            if left[0] == right[0] == "constant":
+                node = ("constant", fold(node[0], left[1], right[1]))
+            elif node[0] in ["add", "multiply"]:
+                node = (node[0], *sorted([left, right], key=repr))
+            else:
+                node = (node[0], left, right)
+        # hash-consing: one object by distinct subexpression
+        return nodes.setdefault(node, node)
+
+    return optimize(parse(formula))
+
+
+def get_elements(tree: tuple) -> set:
+    """
+    get the names of the elements used in an expression tree
+    """
+    if tree[0] == "element":
+        return {tree[1]}
+    if tree[0] == "constant":
+        return set()
+    return get_elements(tree[1]) | get_elements(tree[2])
+
+
+def get_dtypes(tree: tuple, elements: dict) -> dict:
+    """
+    find the dtype of each operation of the tree without reading data,
+    as apply_operation would do with the successive operations
+
+    Return
+    ------
+    dtypes: dict
+        {id of operation node: dtype}
+
+    """
+    result, operands = {}, {}
+
+    def get_operand(node):
+        # operand standing for the node values and their exact integer range
+        if id(node) not in operands:
+            operands[id(node)] = get_new_operand(node)
+        return operands[id(node)]
+
+    def get_new_operand(node):
+        if node[0] == "constant":
+            return node[1], dtypes.get_bounds(node[1])
+        if node[0] == "element":
+            element = elements[node[1]]
+            return element, dtypes.get_bounds(element)
+        (left, left_bounds), (right, right_bounds) = map(get_operand, node[1:])
+        bounds = dtypes.operation_bounds(node[0], left_bounds, right_bounds)
+        if bounds is None:
+            dtype = dtypes.result_dtype(node[0], [left, right])
+        else:
+            dtype = dtypes.smallest_int_dtype(*bounds)
+            if dtype is None:
+                dtype = np.dtype(np.float64)
+        result[id(node)] = dtype
+        if isinstance(left, np.ndarray) or isinstance(right, np.ndarray):
+            return np.empty(0, dtype=dtype), bounds if dtype.kind in "iu" else None
+        # constant result, used with its value
+        left, right = [np.asarray(dtypes.cast_operand(o, dtype)) for o in (left, right)]
+        value = FUNCTIONS[node[0]](left, right, dtype=dtype, casting="unsafe").item()
+        return value, dtypes.get_bounds(value)
+
+    get_operand(tree)
+    return result
+
+
+def evaluate(
+    tree: tuple, elements: dict, workers: int = None, progress=None, cancel=None
+):
+    """
+    evaluate an expression tree in a single pass: the result is computed by
+    blocks along the first axis, each block goes through the whole tree so
+    that intermediate results stay small
+
+    Parameters
+    ----------
+    tree: tuple
+        see parse
+    elements: dict
+        {name: np.ndarray or float}
+    workers: int, default=None
+        number of threads, see parallel.get_workers
+    progress: function, default=None
+        called with the fraction of computed blocks
+    cancel: parallel.CancelToken, default=None
+        checked between blocks
+
+    Return
+    ------
+    result: np.ndarray or numpy scalar
+        a scalar if no element is an array
+
+    """
+    names = get_elements(tree)
+    missing = names - set(elements)
+    if missing:
+        raise ValueError("unknown elements {} in formula".format(sorted(missing)))
+    elements = {name: elements[name] for name in names}
+    node_dtypes = get_dtypes(tree, elements)
+    arrays = {name: e for name, e in elements.items() if isinstance(e, np.ndarray)}
+    shape = np.broadcast_shapes(*[a.shape for a in arrays.values()])
+    arrays = {name: np.broadcast_to(a, shape) for name, a in arrays.items()}
+    if tree[0] == "element":
+        dtype = np.result_type(elements[tree[1]])
+    elif tree[0] == "constant":
+        dtype = np.result_type(tree[1])
+    else:
+        dtype = node_dtypes[id(tree)]
+    out = np.empty(shape, dtype=dtype)
+
+    def evaluate_node(node, chunk, memo, out=None):
+        if node[0] == "constant":
+            value = node[1]
+        elif node[0] == "element":
+            value = arrays[node[1]][chunk] if node[1] in arrays else elements[node[1]]
+        elif out is None and id(node) in memo:
+            # shared subexpression already computed on this block
+            return memo[id(node)]
+        else:
+            dtype = node_dtypes[id(node)]
+            left, right = [
+                np.asarray(dtypes.cast_operand(evaluate_node(n, chunk, memo), dtype))
+                for n in node[1:]
+            ]
+            # the range of the result fits in dtype even if an operand does not,
+            # integer operations wrap the same way on both sides
+            function = FUNCTIONS[node[0]]
+            memo[id(node)] = function(
+                left, right, out=out, dtype=dtype, casting="unsafe"
+            )
+            return memo[id(node)]
+        if out is not None:
+            out[...] = value
+        return value
+
+    def evaluate_chunk(chunk):
+        evaluate_node(tree, chunk, {}, out[chunk])
+
+    chunks = parallel.get_chunks(shape, out.itemsize)
+    parallel.run_tasks(evaluate_chunk, chunks, workers, progress, cancel)
+    return out[()] if out.ndim == 0 else out
@@ -0,0 +1,170 @@
+import numpy as np
+
+
+def smallest_int_dtype(low: int, high: int) -> np.dtype:
+    """
+    find the smallest integer dtype able to store every value in [low, high]
+
+    Parameters
+    ----------
+    low, high: int
+
+    Return
+    ------
+    dtype: np.dtype or None
+        None if no integer dtype is large enough
+
+    """
+    if low < np.iinfo(np.int64).min or high > np.iinfo(np.uint64).max:
+        return None
+    dtype = np.result_type(np.min_scalar_type(low), np.min_scalar_type(high))
+    if dtype.kind not in "iu":
+        # mixing int and uint64 scalar types, int64 may still be enough
+        if high <= np.iinfo(np.int64).max:
+            return np.dtype(np.int64)
+        return None
+    return dtype
+
+
+def get_bounds(operand):
+    """
+    get the range of values an operand can take without reading its data
+
+    Parameters
+    ----------
+    operand: np.ndarray, numpy scalar, int or float
+
+    Return
+    ------
+    bounds: tuple of int or None
+        (low, high) if the operand only contains integers, else None
+
+    """
+    if isinstance(operand, (np.ndarray, np.generic)):
+        if operand.dtype == bool:
+            return 0, 1
+        if operand.dtype.kind in "iu":
+            info = np.iinfo(operand.dtype)
+            return int(info.min), int(info.max)
+        return None
+    if isinstance(operand, (bool, int)):
+        return int(operand), int(operand)
+    if isinstance(operand, float) and operand.is_integer():
+        return int(operand), int(operand)
+    return None
+
+
+def float_dtype(operands: list) -> np.dtype:
+    """
+    get the smallest float dtype able to hold the result of an operation
+    between operands, float32 is used unless an operand requires more.
+    Operations between scalars are computed with float64, as python does
+
+    """
+    dtypes = [o.dtype for o in operands if isinstance(o, (np.ndarray, np.generic))]
+    if not any(isinstance(o, np.ndarray) for o in operands):
+        return np.result_type(np.float64, *dtypes)
+    return np.result_type(np.float32, *dtypes)
+
+
+def operation_bounds(operation: str, bounds: tuple, other: tuple) -> tuple:
+    """
+    get the range of the result of an operation between two integer operands
+
+    Parameters
+    ----------
+    operation: {'add', 'multiply', 'subtract', 'divide'}
+    bounds, other: tuple of int or None
+        (low, high) of the operands, see get_bounds
+
+    Return
+    ------
+    bounds: tuple of int or None
+        None if the result may not be an integer
+
+    """
+    if bounds is None or other is None or operation == "divide":
+        return None
+    (a0, a1), (b0, b1) = bounds, other
+    if operation == "add":
+        return a0 + b0, a1 + b1
+    if operation == "subtract":
+        return a0 - b1, a1 - b0
+    products = [a0 * b0, a0 * b1, a1 * b0, a1 * b1]
+    return min(products), max(products)
+
+
+def result_dtype(operation: str, operands: list) -> np.dtype:
+    """
+    find the smallest safe dtype of the successive operations between
+    operands, integer operands are kept as integer as long as the result
+    range fits in an integer dtype
+
+    Parameters
+    ----------
+    operation: {'add', 'multiply', 'subtract', 'divide'}
+    operands: list of np.ndarray, int or float
+
+    Return
+    ------
+    dtype: np.dtype
+
+    """
+    bounds = get_bounds(operands[0])
+    for operand in operands[1:]:
+        bounds = operation_bounds(operation, bounds, get_bounds(operand))
+
+    if bounds is not None:
+        dtype = smallest_int_dtype(*bounds)
+        # the range overflows every integer dtype
+        return dtype if dtype is not None else np.dtype(np.float64)
+    if operation != "divide" and len(operands) == 1:
+        return np.result_type(operands[0])
+    return float_dtype(operands)
+
+
+def cast_operand(operand, dtype: np.dtype):
+    """
+    convert an integer-valued float scalar to int if the operation is computed
+    with an integer dtype (numpy refuses to cast float inputs to integer)
+
+    """
+    if dtype.kind in "iu" and isinstance(operand, float):
+        return int(operand)
+    return operand
+
+
+def compact(data: np.ndarray, unsigned: bool = False) -> np.ndarray:
+    """
+    convert integer-valued data to the smallest integer dtype able to store it
+
+    Parameters
+    ----------
+    data: np.ndarray
+    unsigned: bool, default=False
+        if True, only convert to unsigned dtypes (e.g. for png/jpg)
+
+    Return
+    ------
+    data: np.ndarray
+        data unchanged if it contains non-integer values
+
+    """
+    if data.dtype == bool:
+        return data.astype(np.uint8)
+    if data.size == 0:
+        return data
+    if data.dtype.kind == "f":
+        if not np.isfinite(data).all() or not (np.round(data) == data).all():
+            return data
+    elif data.dtype.kind not in "iu":
+        return data
+    low, high = int(np.min(data)), int(np.max(data))
+    if unsigned and low < 0:
+        return data
+    dtype = smallest_int_dtype(low, high)
+    if dtype is None or dtype == data.dtype:
+        return data
+    if data.dtype.kind in "iu" and dtype.itemsize >= data.dtype.itemsize:
+        return data
+    return data.astype(dtype)
@@ -1,13 +1,21 @@
+import glob
 import os
 import pickle
+import re
 
 import imageio
 import imageio.core.util
 import nibabel as nib
 import numpy as np
-from skimage import morphology
 
-from src.model.types import ImageInfo, MathOperation, MorphoOperation
+from src.model import calculator, dtypes, morpho, parallel, stats
+from src.model.cache import LOAD_CACHE
+from src.model.types import (
+    ImageInfo,
+    MathOperation,
+    MorphoOperation,
+    ThresholdMethod,
+)
 
 
 # remove imageio warnings
@@ -18,48 +26,190 @@ def silence_imageio_warning(*args, **kwargs):
 imageio.core.util._precision_warn = silence_imageio_warning
 
 
+def read_image(path: str) -> np.ndarray:
+    """
+    read a png/jpg image, remove its alpha channel and convert it to gray
+    if r, g and b channels are equal
+    """
+    data = imageio.imread(path)
+    if data.ndim == 3:
+        # remove alpha channel
+        if data.shape[2] == 4:
+            data = data[:, :, :3]
+        # convert to gray if same value everywhere in each r, g, b canal
+        if (
+            data.shape[2] == 3
+            and (data[:, :, 0] == data[:, :, 1]).all()
+            and (data[:, :, 1] == data[:, :, 2]).all()
+        ):
+            data = data[:, :, 0]
+    return data
+
+
+def get_slice_paths(path: str) -> list[str]:
+    """
+    get the png/jpg images of a directory or matching a glob pattern,
+    sorted in natural order (name2.png before name10.png)
+
+    Return
+    ------
+    paths: list of str
+        empty if path is neither a directory nor a glob pattern
+
+    """
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in os.listdir(path)]
+    elif glob.has_magic(path):
+        paths = glob.glob(path)
+    else:
+        return []
+    paths = [p for p in paths if os.path.splitext(p)[1].lower() in [".png", ".jpg"]]
+
+    def natural_key(p):
+        parts = re.split(r"(\d+)", os.path.basename(p))
+        return [int(part) if part.isdigit() else part for part in parts]
+
+    return sorted(paths, key=natural_key)
+
+
 class Model:
-    def load(self, path: str):
+    def load(
+        self,
+        path: str,
+        lazy: bool = False,
+        use_cache: bool = True,
+        workers: int = None,
+        progress=None,
+        cancel: parallel.CancelToken = None,
+    ):
         """
         this method has a vocation to load any type of file
 
         Parameters
         ----------
         path: str
-            handled extensions: nii, nii.gz, png, jpg, txt, pkl
+            handled extensions: nii, nii.gz, png, jpg, txt, pkl, npy, npz
+            npy files are always memory-mapped (read-only).
+            A directory or a glob pattern of png/jpg 2d images is loaded as
+            a 3d image, images are stacked along the first axis in natural
+            order (as written by 'save')
+        lazy: bool, default=False
+            if True, uncompressed nifti volumes are memory-mapped instead of
+            being read, voxels are only paged in when they are accessed.
+            Compressed (.nii.gz) or scaled volumes cannot be mapped and are
+            read entirely
+        use_cache: bool, default=True
+            if True, get arrays and texts from the process-wide load cache,
+            cached arrays are shared so they are read-only
+        workers: int, default=None
+            number of threads used to decode a directory of 2d images,
+            if None use DEFAULT["workers"] or the number of cpus
+        progress: function, default=None
+            called with the fraction of decoded 2d images
+        cancel: parallel.CancelToken, default=None
+            checked before and after reading and between 2d images,
+            raise parallel.Cancelled if cancelled
 
         Return
         ------
         data: any type of data
 
         """
+        slice_paths = get_slice_paths(path)
+        if not use_cache:
+            return self._read(path, lazy, slice_paths, workers, progress, cancel)
+        key = LOAD_CACHE.key(path, slice_paths or None, lazy=lazy)
+        data = LOAD_CACHE.get(key)
+        if data is None:
+            data = self._read(path, lazy, slice_paths, workers, progress, cancel)
+            LOAD_CACHE.put(key, data)
+        return data
+
+    def _read(
+        self,
+        path: str,
+        lazy: bool = False,
+        slice_paths: list[str] = None,
+        workers: int = None,
+        progress=None,
+        cancel: parallel.CancelToken = None,
+    ):
+        if cancel is not None:
+            cancel.check()
         root, ext = os.path.splitext(path)
-        if ext == ".txt":
+        if slice_paths:
+            data = self._read_slices(slice_paths, workers, progress, cancel)
+        elif ext == ".txt":
             with open(path, "r") as f:
                 data = f.read()
         elif ext == ".pkl":
             with open(path, "rb") as f:
                 data = pickle.load(f)
+        elif ext == ".npy":
+            data = np.load(path, mmap_mode="r")
+        elif ext == ".npz":
+            with np.load(path) as npz:
+                data = {name: npz[name] for name in npz.files}
+            # single unnamed array saved with np.savez(path, array)
+            if list(data) == ["arr_0"]:
+                data = data["arr_0"]
         elif ext == ".nii" or path.endswith(".nii.gz"):
-            data = nib.load(path).get_fdata()
+            img = nib.load(path, mmap="r" if lazy else False)
+            # keep the on-disk dtype (nibabel only converts scaled data to float)
+            # if lazy, it is a read-only np.memmap when the data is unscaled
+            data = np.asanyarray(img.dataobj)
         elif ext in [".png", ".jpg"]:
-            data = imageio.imread(path)
-            if data.ndim == 3:
-                # remove alpha channel
-                if data.shape[2] == 4:
-                    data = data[:, :, :3]
-                # convert to gray if same value everywhere in each r, g, b canal
-                if (
-                    data.shape[2] == 3
-                    and (data[:, :, 0] == data[:, :, 1]).all()
-                    and (data[:, :, 1] == data[:, :, 2]).all()
-                ):
-                    data = data[:, :, 0]
+            data = read_image(path)
         else:
             raise TypeError("{} not handle yet".format(ext))
+        if cancel is not None:
+            # stopped while reading, the data is not used
+            cancel.check()
         return data
 
-    def save(self, data, path: str):
+    def _read_slices(
+        self,
+        paths: list[str],
+        workers: int = None,
+        progress=None,
+        cancel: parallel.CancelToken = None,
+    ) -> np.ndarray:
+        """
+        decode 2d images concurrently, directly inside a preallocated 3d array
+        """
+        first = read_image(paths[0])
+        volume = np.empty((len(paths),) + first.shape, dtype=first.dtype)
+        volume[0] = first
+
+        def read_slice(i):
+            data = read_image(paths[i])
+            if data.shape != first.shape:
+                raise ValueError(
+                    "{0} has shape {1}, expected {2}".format(
+                        paths[i], data.shape, first.shape
+                    )
+                )
+            if data.dtype != first.dtype:
+                raise ValueError(
+                    "{0} has dtype {1}, expected {2}".format(
+                        paths[i], data.dtype, first.dtype
+                    )
+                )
+            volume[i] = data
+
+        parallel.run_tasks(
+            read_slice, range(1, len(paths)), workers, progress, cancel
+        )
+        return volume
+
+    def save(
+        self,
+        data,
+        path: str,
+        workers: int = None,
+        progress=None,
+        cancel: parallel.CancelToken = None,
+    ):
         """
         this method has a vocation to save any type of file
 
@@ -67,6 +217,15 @@ class Model:
         ----------
         data: any type of data
         path: str
+            npy handles arrays, npz handles arrays and dict/list of arrays
+        workers: int, default=None
+            number of threads used to write 3d images as a directory of 2d
+            images, if None use DEFAULT["workers"] or the number of cpus
+        progress: function, default=None
+            called with the fraction of written 2d images
+        cancel: parallel.CancelToken, default=None
+            checked before and after writing and between 2d images,
+            raise parallel.Cancelled if cancelled
 
         Return
         ------
@@ -74,6 +233,8 @@ class Model:
             message to inform the saved path
 
         """
+        if cancel is not None:
+            cancel.check()
         root, ext = os.path.splitext(path)
         if ext == ".txt":
             with open(path, "w") as f:
@@ -81,12 +242,21 @@ class Model:
         elif ext == ".pkl":
             with open(path, "wb") as f:
                 pickle.dump(data, f)
+        elif ext == ".npy":
+            np.save(path, data, allow_pickle=False)
+        elif ext == ".npz":
+            if isinstance(data, dict):
+                np.savez(path, **data)
+            elif isinstance(data, (list, tuple)):
+                np.savez(path, *data)
+            else:
+                np.savez(path, data)
         elif isinstance(data, np.ndarray):
-            if ext in [".nii.gz", ".nii"]:
-                ni_img = nib.Nifti1Image(data, None)
+            if ext in [".nii.gz", ".nii"] or path.endswith(".nii.gz"):
+                ni_img = nib.Nifti1Image(dtypes.compact(data), None)
                 nib.save(ni_img, path)
             elif ext in [".png", ".jpg"]:
-                data = np.squeeze(data)
+                data = dtypes.compact(np.squeeze(data), unsigned=True)
                 if data.ndim == 3 and np.min(data.shape) < 5:
                     # save 3d image as rgb or rgba image if possible
                     # (smaller dimension send to the end)
@@ -97,12 +267,21 @@ class Model:
                     if not os.path.exists(root):
                         os.makedirs(root)
                     head, tail = os.path.split(root)
-                    for i in range(data.shape[0]):
+
+                    def save_slice(i):
+                        # every slice keeps the dtype of the compacted volume
                         new_path = os.path.join(root, tail + str(i) + ext)
-                        self.save(data[i], new_path)
+                        imageio.imwrite(new_path, data[i])
+
+                    parallel.run_tasks(
+                        save_slice, range(data.shape[0]), workers, progress, cancel
+                    )
                     return "images are saved in directory {}".format(root)
 
                 imageio.imwrite(path, data)
+        if cancel is not None:
+            # stopped while writing, the file may be incomplete
+            cancel.check()
         return "saved as {}".format(path)
 
     def extract_channel(self, im, channel="red"):
@@ -126,26 +305,60 @@ class Model:
         idx = ["red", "green", "blue"].index(channel)
         return im[:, :, idx]
 
-    def get_img_infos(self, im, info="max"):
+    def get_statistics(
+        self, data, workers: int = None, lazy: bool = False
+    ) -> stats.Statistics:
+        """
+        compute the statistics of a result in a single pass
+
+        Parameters
+        ----------
+        data: any type data
+        workers: int, default=None
+            number of threads, if None use DEFAULT["workers"] or the number of cpus
+        lazy: bool, default=False
+            if True, the statistics are computed the first time they are used
+
+        Return
+        ------
+        statistics: stats.Statistics or None
+            None if data is not a numeric array
+
+        """
+        if not isinstance(data, np.ndarray) or data.dtype.kind not in "biuf":
+            return None
+        return stats.Statistics(data, workers, lazy)
+
+    def get_img_infos(
+        self,
+        im,
+        info: ImageInfo = "max",
+        statistics: stats.Statistics = None,
+        workers: int = None,
+    ):
         """
-        get info of the input image
+        get info of the input image, nan and inf values are ignored
 
         Parameters
         ----------
         im: 2D/3D numpy array
-        info: {'max', 'min', 'mean'}, default='max'
+            not used if statistics are given
+        info: {'max', 'min', 'mean', 'std', 'median'}, default='max'
+            the median of float data is interpolated from the histogram
+        statistics: stats.Statistics, default=None
+            statistics of im if already computed
+        workers: int, default=None
+            number of threads used to compute statistics,
+            if None use DEFAULT["workers"] or the number of cpus
 
         Return
         -------
         result: float
             info you want to extract from the image
         """
-        function = {
-            "min": np.min,
-            "max": np.max,
-            "mean": np.mean,
-        }.get(info)
-        return function(im)
+        if statistics is None:
+            statistics = stats.Statistics(im, workers)
+        return statistics.get(info)
 
     def apply_basic_morpho(
         self,
@@ -153,19 +366,32 @@ class Model:
         size: int,
         operation: MorphoOperation = "erosion",
         round_shape: bool = True,
+        workers: int = None,
+        progress=None,
+        cancel: parallel.CancelToken = None,
     ) -> np.ndarray:
         """
         Apply basic morphological operation on the input image
 
+        Square and cube elements are applied as separable 1d passes, disk and
+        ball elements from morpho.DECOMPOSITION_RADIUS are approximated by a
+        sequence of lines, so that runtime grows linearly with size.
+        Binary operations with large disks and balls use the distance
+        transform. 3d images are processed by blocks on a thread pool
+
         Parameters
         ----------
         im: 2d/3d numpy array
         size: int
             Generate an element of size (size*2+1)
-        operation: {'erosion', 'dilation', 'binary_erosion', 'binary_dilation'}, default='erosion'
+        operation: {'erosion', 'dilation', 'opening', 'closing'}, default='erosion'
+            prefixed by 'binary_' for binary operations
         round_shape: str, default=True
             If True the element is ball (3d) or disk (2d),
             else the element is cube (3d) or square (2d)
+        workers: int, default=None
+            number of threads used on 3d images,
+            if None use DEFAULT["workers"] or the number of cpus
 
         Returns
         -------
@@ -175,28 +401,18 @@ class Model:
         """
         if size == 0:
             return im
-        if len(im.shape) == 3:
-            selem = (
-                morphology.ball(size) if round_shape else morphology.cube(size * 2 + 1)
-            )
-        elif len(im.shape) == 2:
-            selem = (
-                morphology.disk(size)
-                if round_shape
-                else morphology.square(size * 2 + 1)
-            )
-        function = {
-            "erosion": morphology.erosion,
-            "dilation": morphology.dilation,
-            "binary_erosion": morphology.binary_erosion,
-            "binary_dilation": morphology.binary_dilation,
-            "opening": morphology.opening,
-            "closing": morphology.opening,
-        }.get(operation)
-        return function(im, selem)
+        return morpho.apply_morpho(
+            im, size, operation, round_shape, workers, progress, cancel
+        )
 
     def apply_operation(
-        self, arr: np.ndarray, elements=[], operation: MathOperation = "add"
+        self,
+        arr: np.ndarray,
+        elements=[],
+        operation: MathOperation = "add",
+        workers: int = None,
+        progress=None,
+        cancel: parallel.CancelToken = None,
     ) -> np.ndarray:
         """
         Parameters
@@ -204,11 +420,19 @@ class Model:
         arr: 2d/3d array
         elements: list of 2d/3d arrays or float, default=[]
         operation: {'add', 'multiply', 'subtract', 'divide'}, default='add'
-        output_minimize_bytes: bool, default=True
+        workers: int, default=None
+            number of threads, blocks of the result are computed concurrently,
+            if None use DEFAULT["workers"] or the number of cpus
+        progress: function, default=None
+            called with the fraction of computed blocks
+        cancel: parallel.CancelToken, default=None
+            checked between blocks, raise parallel.Cancelled if cancelled
 
         Return
         ------
         arr: 2d/3d array
+            its dtype is the smallest one able to store the result
+            (see dtypes.result_dtype), a numpy scalar if no operand is an array
         """
         if not isinstance(elements, list):
             elements = [elements]
@@ -218,73 +442,65 @@ class Model:
             "multiply": np.multiply,
             "divide": np.divide,
         }.get(operation)
-        for element in elements:
-            arr = function(arr, element, dtype=np.float64)
-        return arr
-
-    def _apply_formula_recursively(self, fml, elems, elem_id=0):
-        if len(fml) == 1:
-            if fml[0].startswith("["):
-                res = elems[fml[0][1:-1]]
-            else:
-                res = eval(fml[0])
-        # apply pear operation (with one operator and two elements)
-        # example [Load_1] x 5
-        elif len(fml) == 3 and fml[1] in signs:
-            op_sign = fml.pop(1)
-            for i, f in enumerate(fml):
-                if f.startswith("["):
-                    fml[i] = elems[f[1:-1]]
-                else:
-                    fml[i] = eval(f)
-            for operation, sign in zip(operations, signs):
-                if op_sign == sign:
-                    res = self.apply_operation(fml[0], fml[1], operation)
-        else:
-            # recursively apply formula on group in parenthesis
-            if "(" in fml:
-                for i, f in enumerate(fml):
-                    if f == "(":
-                        start = i
-                    elif f == ")":
-                        end = i + 1
-                        break
-                sub_fml = fml[start + 1 : end - 1]
-
-            # recursively apply formula on prioritary pear operations
-            else:
-                for sign in signs:
-                    if sign in fml:
-                        start = fml.index(sign) - 1
-                        end = fml.index(sign) + 2
-                        break
-                sub_fml = fml[start:end]
-
-            # do recusrsivity
-            name = "_ID{}".format(elem_id)
-            elem_id += 1
-            res, elem_id = self._apply_formula_recursively(sub_fml, elems, elem_id)
-            elems[name] = res
-            fml = fml[:start] + ["[{}]".format(name)] + fml[end:]
-            res, elem_id = self._apply_formula_recursively(fml, elems, elem_id)
-        return res, elem_id
-
-    def apply_formula(self, formula: str, elements: dict):
+        operands = [arr] + elements
+        dtype = dtypes.result_dtype(operation, operands)
+        operands = [dtypes.cast_operand(o, dtype) for o in operands]
+        shape = np.broadcast_shapes(*[np.shape(o) for o in operands])
+        # every block is folded in place in the result, no temporary array
+        operands = [
+            np.broadcast_to(o, shape) if isinstance(o, np.ndarray) else o
+            for o in operands
+        ]
+        out = np.empty(shape, dtype=dtype)
+
+        def apply_chunk(chunk):
+            if len(operands) == 1:
+                out[chunk] = operands[0][chunk]
+                return
+            first, *others = [
+                o[chunk] if isinstance(o, np.ndarray) else o for o in operands
+            ]
+            function(first, others[0], out=out[chunk], dtype=dtype)
+            for element in others[1:]:
+                function(out[chunk], element, out=out[chunk], dtype=dtype)
+
+        chunks = parallel.get_chunks(shape, out.itemsize)
+        parallel.run_tasks(apply_chunk, chunks, workers, progress, cancel)
+        return out[()] if out.ndim == 0 else out
+
+    def apply_formula(
+        self,
+        formula: str,
+        elements: dict,
+        workers: int = None,
+        progress=None,
+        cancel: parallel.CancelToken = None,
+    ):
         """
         This function calculate complexe operations between float/int and images
         it handles parenthesis grouping and operator priorities.
-        And it calls "apply_operation" to do pear operations recursively.
+        The formula is compiled once into an expression tree evaluated by blocks
+        in a single pass, without full-size intermediate results, and shared
+        subexpressions are computed once.
 
         Parameters
         ----------
         formula: str
         elements: dict
             this dictionary contains data (image or float/int...)
+        workers: int, default=None
+            number of threads, blocks of the result are computed concurrently,
+            if None use DEFAULT["workers"] or the number of cpus
+        progress: function, default=None
+            called with the fraction of computed blocks
+        cancel: parallel.CancelToken, default=None
+            checked between blocks, raise parallel.Cancelled if cancelled
 
         Return
         ------
         result: np.ndarray or int/float
-            the result type depends on the formula.
+            the result type depends on the formula, its dtype is chosen as
+            in apply_operation for each operation.
 
         Example
         -------
@@ -293,35 +509,14 @@ class Model:
                     'key_2': np.array([...]),   # image
                     'key_3': 2}                 # integer
 
-        This will recursively apply (call self.apply_operation method):
-            - M1 = multiplication of key_1 image and 3
-            - M2 = multiplication of key_2 image and 4
+        For each block of the images, this computes:
+            - M1 = multiplication of key_1 block and 3
+            - M2 = multiplication of key_2 block and 4
             - A1 = addition of M1 and M2
             - result = division of A1 and key_3 value
         """
-        # operations ordered on priorities
-        operations = ["multiply", "divide", "add", "subtract"]
-        signs = ["x", "÷", "+", "-"]
-
-        # initialize formula
-        formula = formula.replace(",", ".")
-        formula = formula.replace(" ", "")
-
-        # add space where we need to split formula
-        formula = list(formula)
-        for i, f in reversed(list(enumerate(formula))):
-            # check if '-' is minus and not subtract
-            if f == "-" and (i == 0 or formula[i - 1] in signs + ["("]):
-                formula[i] = "-1 x "
-            elif f in signs + ["(", ")"]:
-                formula[i] = " {} ".format(f)
-        formula = "".join(formula)
-        # split formula
-        formula = formula.split(" ")
-        formula = [f for f in formula if f]
-
-        result, _ = self._apply_formula_recursively(formula, elements)
-        return result
+        tree = calculator.compile_formula(formula)
+        return calculator.evaluate(tree, elements, workers, progress, cancel)
 
     def apply_threshold(
         self,
@@ -329,6 +524,11 @@ class Model:
         threshold: float,
         reverse: bool = False,
         thresholdInPercentage: bool = False,
+        method: ThresholdMethod = "value",
+        statistics: stats.Statistics = None,
+        workers: int = None,
+        progress=None,
+        cancel: parallel.CancelToken = None,
     ) -> np.ndarray:
         """
         Apply binary threshold on the input image
@@ -341,6 +541,20 @@ class Model:
         reverse: bool, default=False
             If True invert 0 and 1 in output
         thresholdInPercentage: bool, default=False
+            If True threshold is a percentage of the range [min, max]
+            (only with method 'value')
+        method: {'value', 'percentile', 'otsu'}, default='value'
+            'percentile': threshold is the percentage of pixels below it
+            'otsu': threshold is computed with Otsu's method
+        statistics: stats.Statistics, default=None
+            statistics of im if already computed
+        workers: int, default=None
+            number of threads used to compute statistics and the mask,
+            if None use DEFAULT["workers"] or the number of cpus
+        progress: function, default=None
+            called with the fraction of computed blocks of the mask
+        cancel: parallel.CancelToken, default=None
+            checked between blocks, raise parallel.Cancelled if cancelled
 
         Returns
         -------
@@ -348,8 +562,22 @@ class Model:
             Binarized input image with same size as im
 
         """
-        if thresholdInPercentage:
-            mini, maxi = np.min(im), np.max(im)
-            threshold = mini + threshold * (maxi - mini) / 100
-        mask = im < threshold if reverse else im > threshold
-        return mask.astype(np.uint8)
+        if method != "value" or thresholdInPercentage:
+            if statistics is None:
+                statistics = stats.Statistics(im, workers)
+            if method == "percentile":
+                threshold = statistics.percentile(threshold)
+            elif method == "otsu":
+                threshold = statistics.otsu()
+            else:
+                mini, maxi = statistics.min, statistics.max
+                threshold = mini + threshold * (maxi - mini) / 100
+        mask = np.empty(im.shape, dtype=np.uint8)
+        compare = np.less if reverse else np.greater
+
+        def apply_chunk(chunk):
+            compare(im[chunk], threshold, out=mask[chunk], casting="unsafe")
+
+        chunks = parallel.get_chunks(im.shape, im.itemsize)
+        parallel.run_tasks(apply_chunk, chunks, workers, progress, cancel)
+        return mask
@@ -0,0 +1,339 @@
+import functools
+import itertools
+
+import numpy as np
+from scipy import ndimage
+from skimage import morphology
+
+from src.model import parallel
+
+# from this radius, disks and balls are approximated by a sequence of lines
+DECOMPOSITION_RADIUS = 8
+# from this radius (by number of dimensions), binary operations with disks
+# and balls use the distance transform (crossover measured with
+# benchmarks/morpho_engines.py)
+EDT_RADIUS = {2: 20, 3: 8}
+# up to this radius, the lines are chosen to best overlap the exact element
+MAX_SEARCH_RADIUS = 32
+
+# length of the diagonal lines approximating a disk (2d) or a ball (3d) of
+# radius 1, by number of non-zero coordinates of the line direction (face and
+# body diagonals). With the axis lines, the element extent is the radius along
+# axes and diagonals (a regular octagon in 2d)
+LINE_WEIGHTS = {
+    2: {2: 1 - 1 / np.sqrt(2)},
+    3: {2: 1 / np.sqrt(2) - 1 / np.sqrt(3), 3: (1 - np.sqrt(2) + 1 / np.sqrt(3)) / 2},
+}
+
+
+@functools.lru_cache(maxsize=32)
+def get_footprint(ndim: int, radius: int, round_shape: bool = True) -> np.ndarray:
+    """
+    get a cached (read-only) structuring element of size (radius*2+1)
+
+    Parameters
+    ----------
+    ndim: {2, 3}
+    radius: int
+    round_shape: bool, default=True
+        If True the element is ball (3d) or disk (2d),
+        else the element is cube (3d) or square (2d)
+
+    """
+    if round_shape:
+        footprint = morphology.ball(radius) if ndim == 3 else morphology.disk(radius)
+    else:
+        footprint = np.ones((radius * 2 + 1,) * ndim, dtype=np.uint8)
+    footprint.flags.writeable = False
+    return footprint
+
+
+@functools.lru_cache(maxsize=32)
+def get_decomposition(ndim: int, radius: int) -> tuple:
+    """
+    approximate a disk (2d) or a ball (3d) by a sequence of lines, the
+    morphological operation with the element is the successive operations
+    with each line
+
+    Return
+    ------
+    lines: tuple of (direction, length)
+        each line contains the offsets k*direction for k in [-length, length]
+
+    """
+    # one direction of each pair (d, -d)
+    directions = [
+        d for d in itertools.product((-1, 0, 1), repeat=ndim) if d > (0,) * ndim
+    ]
+    orders = [np.count_nonzero(d) for d in directions]
+
+    def get_lines(diagonal_lengths, axis_delta):
+        lengths = dict(zip(LINE_WEIGHTS[ndim], diagonal_lengths))
+        # the extent along axes is the radius (+ axis_delta)
+        extent = sum(lengths[o] for d, o in zip(directions, orders) if o > 1 and d[0])
+        lengths[1] = max(0, radius - extent + axis_delta)
+        return tuple((d, lengths[o]) for d, o in zip(directions, orders))
+
+    if radius > MAX_SEARCH_RADIUS:
+        return get_lines([round(w * radius) for w in LINE_WEIGHTS[ndim].values()], 0)
+
+    exact = get_footprint(ndim, radius).astype(bool)
+
+    def get_overlap(lines):
+        # jaccard index between the approximated and the exact elements
+        element = np.zeros(exact.shape, dtype=bool)
+        element[(radius,) * ndim] = True
+        for direction, length in lines:
+            element = apply_line(element, direction, length, "dilation")
+        return np.sum(element & exact) / np.sum(element | exact)
+
+    # round the ideal lengths to the integers giving the closest element
+    candidates = itertools.product(
+        itertools.product(
+            *[
+                {int(np.floor(w * radius)), int(np.ceil(w * radius))}
+                for w in LINE_WEIGHTS[ndim].values()
+            ]
+        ),
+        [-1, 0, 1],
+    )
+    return max([get_lines(*c) for c in candidates], key=get_overlap)
+
+
+def get_neutral(dtype: np.dtype, operation: str):
+    """
+    get the value which has no effect on an erosion (max) or a dilation (min),
+    it is used outside the image
+    """
+    if dtype == bool:
+        return operation == "erosion"
+    if dtype.kind == "f":
+        return np.inf if operation == "erosion" else -np.inf
+    info = np.iinfo(dtype)
+    return info.max if operation == "erosion" else info.min
+
+
+def apply_line(im: np.ndarray, direction: tuple, length: int, operation: str):
+    """
+    apply an erosion or a dilation with a line element
+    """
+    if length == 0:
+        return im
+    cval = get_neutral(im.dtype, operation)
+    axes = np.flatnonzero(direction)
+    if len(axes) == 1:
+        function = {
+            "erosion": ndimage.minimum_filter1d,
+            "dilation": ndimage.maximum_filter1d,
+        }.get(operation)
+        return function(
+            im, length * 2 + 1, axis=axes[0], mode="constant", cval=cval
+        )
+
+    direction = np.array(direction)
+    footprint = np.zeros(np.abs(direction) * length * 2 + 1, dtype=bool)
+    center = np.abs(direction) * length
+    for k in range(-length, length + 1):
+        footprint[tuple(center + k * direction)] = True
+    function = {
+        "erosion": ndimage.minimum_filter,
+        "dilation": ndimage.maximum_filter,
+    }.get(operation)
+    return function(im, footprint=footprint, mode="constant", cval=cval)
+
+
+def apply_dense(
+    im: np.ndarray, radius: int, operation: str, round_shape: bool = True
+) -> np.ndarray:
+    """
+    apply an erosion or a dilation with the exact structuring element,
+    the runtime grows with the number of pixels of the element
+    """
+    footprint = get_footprint(im.ndim, radius, round_shape)
+    if im.dtype == bool:
+        if operation == "erosion":
+            return ndimage.binary_erosion(im, footprint, border_value=True)
+        return ndimage.binary_dilation(im, footprint, border_value=False)
+    function = {
+        "erosion": ndimage.grey_erosion,
+        "dilation": ndimage.grey_dilation,
+    }.get(operation)
+    return function(im, footprint=footprint)
+
+
+def apply_distance(im: np.ndarray, radius: int, operation: str) -> np.ndarray:
+    """
+    apply a binary erosion or dilation with a disk or a ball through the
+    euclidean distance transform, the runtime does not depend on the radius.
+
+    The result is the same as with the exact element: a pixel is in the
+    element if its squared distance to the center is at most radius**2, and
+    the distance of a pixel to another is either radius or far from it.
+    As with ndimage binary operations, the outside of the image is foreground
+    for an erosion and background for a dilation
+    """
+    if operation == "erosion":
+        if im.all():
+            return im.copy()
+        # distance to the nearest background pixel
+        return ndimage.distance_transform_edt(im) > radius
+    if not im.any():
+        return im.copy()
+    # distance to the nearest foreground pixel
+    return ndimage.distance_transform_edt(~im) <= radius
+
+
+def apply_elementary(
+    im: np.ndarray, radius: int, operation: str, round_shape: bool = True
+) -> np.ndarray:
+    """
+    apply an erosion or a dilation with the fastest engine
+
+    - square and cube elements are applied as separable 1d passes
+    - binary operations with disks and balls from EDT_RADIUS go through the
+      euclidean distance transform (exact)
+    - other operations with disks and balls from DECOMPOSITION_RADIUS are
+      applied as a sequence of lines (approximation)
+    - smaller disks and balls are applied with the exact element
+
+    Parameters
+    ----------
+    im: 2d/3d numpy array
+        binary operations are applied on boolean arrays
+    radius: int
+    operation: {'erosion', 'dilation'}
+    round_shape: bool, default=True
+
+    """
+    if not round_shape:
+        for axis in range(im.ndim):
+            direction = tuple(int(i == axis) for i in range(im.ndim))
+            im = apply_line(im, direction, radius, operation)
+        return im
+
+    if im.dtype == bool:
+        if radius >= EDT_RADIUS[im.ndim]:
+            return apply_distance(im, radius, operation)
+    elif radius >= DECOMPOSITION_RADIUS:
+        for direction, length in get_decomposition(im.ndim, radius):
+            im = apply_line(im, direction, length, operation)
+        return im
+
+    return apply_dense(im, radius, operation, round_shape)
+
+
+def apply_tiled(
+    function,
+    im: np.ndarray,
+    halo: int,
+    dtype: np.dtype,
+    workers: int = None,
+    progress=None,
+    cancel: parallel.CancelToken = None,
+) -> np.ndarray:
+    """
+    split a volume along its first axis into blocks with a halo, apply the
+    function on each block on a thread pool and stitch the blocks without
+    their halo. The result is the same as function(im) if the result of a
+    pixel only depends on pixels closer than the halo along the first axis
+
+    Parameters
+    ----------
+    function: function
+        called on each block, returns an array with the shape of the block
+    im: 3d numpy array
+    halo: int
+    dtype: np.dtype
+        dtype of the result
+    workers: int, default=None
+        number of threads, see parallel.get_workers
+    progress: function, default=None
+        called with the fraction of processed blocks
+    cancel: parallel.CancelToken, default=None
+        checked between blocks
+
+    """
+    workers = parallel.get_workers(workers)
+    nblocks = min(workers, im.shape[0])
+    if progress is not None or cancel is not None:
+        # more blocks than threads for a finer progress, as long as the
+        # halo stays small compared to the blocks
+        nblocks = max(nblocks, min(8, im.shape[0] // (8 * halo)))
+    if nblocks == 1:
+        return apply_whole(function, im, progress, cancel)
+    bounds = np.linspace(0, im.shape[0], nblocks + 1).astype(int)
+    out = np.empty(im.shape, dtype=dtype)
+
+    def apply_block(i):
+        start, stop = bounds[i], bounds[i + 1]
+        low, high = max(0, start - halo), min(im.shape[0], stop + halo)
+        out[start:stop] = function(im[low:high])[start - low : stop - low]
+
+    parallel.run_tasks(apply_block, range(nblocks), workers, progress, cancel)
+    return out
+
+
+def apply_whole(
+    function, im: np.ndarray, progress=None, cancel: parallel.CancelToken = None
+) -> np.ndarray:
+    """
+    apply the function on the whole image, cancel is checked before and after
+    """
+    if cancel is not None:
+        cancel.check()
+    im = function(im)
+    if cancel is not None:
+        cancel.check()
+    if progress is not None:
+        progress(1.0)
+    return im
+
+
+def apply_morpho(
+    im: np.ndarray,
+    radius: int,
+    operation: str,
+    round_shape: bool = True,
+    workers: int = None,
+    progress=None,
+    cancel: parallel.CancelToken = None,
+) -> np.ndarray:
+    """
+    apply a morphological operation, 3d images are split in blocks processed
+    on a thread pool
+
+    Parameters
+    ----------
+    im: 2d/3d numpy array
+    radius: int
+    operation: {'erosion', 'dilation', 'opening', 'closing'}
+        prefixed by 'binary_' for binary operations
+    round_shape: bool, default=True
+    workers: int, default=None
+        number of threads, see parallel.get_workers
+    progress: function, default=None
+        called with the fraction of processed blocks
+    cancel: parallel.CancelToken, default=None
+        checked between blocks, raise parallel.Cancelled if cancelled
+
+    """
+    if operation.startswith("binary_"):
+        im = im.astype(bool, copy=False)
+        operation = operation[len("binary_") :]
+    steps = {
+        "erosion": ["erosion"],
+        "dilation": ["dilation"],
+        "opening": ["erosion", "dilation"],
+        "closing": ["dilation", "erosion"],
+    }.get(operation)
+
+    def apply_steps(block):
+        for step in steps:
+            block = apply_elementary(block, radius, step, round_shape)
+        return block
+
+    if im.ndim < 3:
+        return apply_whole(apply_steps, im, progress, cancel)
+    # decomposed elements may exceed the radius by one along axes
+    halo = (radius + 1) * len(steps)
+    return apply_tiled(apply_steps, im, halo, im.dtype, workers, progress, cancel)
@@ -0,0 +1,149 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import RawValue
+
+import numpy as np
+
+from src import DEFAULT
+
+# size of the blocks processed at once by chunked operations, small enough to
+# keep the operands in cpu cache while they are combined
+CHUNK_BYTES = 2**21
+
+
+class Cancelled(Exception):
+    """
+    raised by an operation stopped through its CancelToken
+    """
+
+
+class CancelToken:
+    """
+    flag checked by an operation between blocks to stop cleanly, it can be
+    shared with a process created after it
+
+    Parameters
+    ----------
+    value: RawValue, default=None
+        shared flag, if None a new one is created
+
+    """
+
+    def __init__(self, value: RawValue = None):
+        self.value = RawValue("b", 0) if value is None else value
+
+    def cancel(self):
+        self.value.value = 1
+
+    def reset(self):
+        self.value.value = 0
+
+    @property
+    def cancelled(self) -> bool:
+        return bool(self.value.value)
+
+    def check(self):
+        """
+        raise Cancelled if the operation is cancelled
+        """
+        if self.cancelled:
+            raise Cancelled("the operation was cancelled")
+
+
+def get_workers(workers: int = None) -> int:
+    """
+    get the number of workers to use
+
+    Parameters
+    ----------
+    workers: int, default=None
+        if None or 0, use DEFAULT["workers"] or the number of cpus
+
+    """
+    if not workers:
+        workers = DEFAULT.get("workers") or os.cpu_count() or 1
+    return max(1, int(workers))
+
+
+def run_tasks(
+    function,
+    items: list,
+    workers: int = None,
+    progress=None,
+    cancel: CancelToken = None,
+) -> list:
+    """
+    call a function on each item concurrently on a thread pool
+    (numpy, scipy and image encoders release the GIL on heavy work)
+
+    Parameters
+    ----------
+    function: function
+        called as function(item)
+    items: list
+    workers: int, default=None
+        number of threads, see get_workers
+    progress: function, default=None
+        called with the fraction of processed items each time an item is done
+    cancel: CancelToken, default=None
+        checked before each item, the items not started are skipped
+        and Cancelled is raised
+
+    Return
+    ------
+    results: list
+        function results, in the same order as items
+
+    """
+    items = list(items)
+    workers = min(get_workers(workers), max(1, len(items)))
+    results = [None] * len(items)
+
+    def run(item):
+        if cancel is not None:
+            cancel.check()
+        return function(item)
+
+    if workers == 1:
+        for i, item in enumerate(items):
+            results[i] = run(item)
+            if progress is not None:
+                progress((i + 1) / len(items))
+        return results
+
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {executor.submit(run, item): i for i, item in enumerate(items)}
+        try:
+            for done, future in enumerate(as_completed(futures)):
+                results[futures[future]] = future.result()
+                if progress is not None:
+                    progress((done + 1) / len(items))
+        except BaseException:
+            executor.shutdown(cancel_futures=True)
+            raise
+    return results
+
+
+def get_chunks(shape: tuple, itemsize: int, chunk_bytes: int = CHUNK_BYTES) -> list:
+    """
+    split an array along its first axis into blocks of about chunk_bytes
+
+    Parameters
+    ----------
+    shape: tuple
+        shape of the array
+    itemsize: int
+        number of bytes of an element
+    chunk_bytes: int, default=CHUNK_BYTES
+
+    Return
+    ------
+    chunks: list of slices
+        indexes of the blocks, [...] for 0d arrays
+
+    """
+    if len(shape) == 0:
+        return [Ellipsis]
+    row_bytes = int(np.prod(shape[1:])) * itemsize
+    rows = max(1, chunk_bytes // max(1, row_bytes))
+    return [slice(i, i + rows) for i in range(0, shape[0], rows)] or [slice(None)]
@@ -0,0 +1,276 @@
+import threading
+
+import numpy as np
+
+from src.model import parallel
+
+# number of bins of the histogram of data without exact histogram
+BINS = 4096
+
+
+class Statistics:
+    """
+    summary of an array computed in a single pass by blocks, nan and inf
+    values are ignored.
+
+    Data with 8 or 16 bits integer (or boolean) values get an exact histogram
+    in the same pass, other data get a histogram over [min, max] the first
+    time it is needed (one bin by value for integers with less than BINS
+    values, else BINS bins). Percentiles and automatic thresholds are then
+    read from the histogram without reading the data again.
+
+    Parameters
+    ----------
+    data: np.ndarray
+    workers: int, default=None
+        number of threads, see parallel.get_workers
+    lazy: bool, default=False
+        if True, the data is only read the first time a statistic is needed
+
+    """
+
+    def __init__(self, data: np.ndarray, workers: int = None, lazy: bool = False):
+        self.data = data
+        self.workers = workers
+        self.shape, self.dtype = data.shape, data.dtype
+        self._summary = None
+        self._histogram = None
+        self._lock = threading.RLock()
+        if not lazy:
+            self.summarize()
+
+    @property
+    def computed(self) -> bool:
+        """
+        True if the data was already read
+        """
+        return self._summary is not None
+
+    @property
+    def count(self) -> int:
+        return self.summarize()["count"]
+
+    @property
+    def min(self) -> float:
+        return self.summarize()["min"]
+
+    @property
+    def max(self) -> float:
+        return self.summarize()["max"]
+
+    @property
+    def mean(self) -> float:
+        return self.summarize()["mean"]
+
+    @property
+    def std(self) -> float:
+        return self.summarize()["std"]
+
+    def summarize(self) -> dict:
+        """
+        read the data once to compute the statistics
+
+        Return
+        ------
+        summary: dict
+            {'count', 'min', 'max', 'mean', 'std'}
+
+        """
+        with self._lock:
+            if self._summary is None:
+                self._summary = self._compute_summary()
+        return self._summary
+
+    def _compute_summary(self) -> dict:
+        data = self.data
+        if data.dtype == bool:
+            data = data.view(np.uint8)
+        exact = data.dtype.kind in "iu" and data.dtype.itemsize <= 2
+        offset = int(np.iinfo(data.dtype).min) if exact else 0
+
+        def summarize_chunk(chunk):
+            chunk = data[chunk]
+            if chunk.dtype.kind == "f":
+                finite = np.isfinite(chunk)
+                count = np.count_nonzero(finite)
+                low, high = np.inf, -np.inf
+            else:
+                finite, count = True, chunk.size
+                low, high = np.iinfo(chunk.dtype).max, np.iinfo(chunk.dtype).min
+            mean = np.sum(chunk, where=finite, dtype=np.float64) / max(count, 1)
+            # sum of squared deviations to the mean of the chunk
+            deviations = np.square(np.subtract(chunk, mean, dtype=np.float64))
+            summary = {
+                "min": np.min(chunk, where=finite, initial=low),
+                "max": np.max(chunk, where=finite, initial=high),
+                "count": count,
+                "mean": mean,
+                "m2": np.sum(deviations, where=finite),
+            }
+            if exact:
+                values = chunk.ravel()
+                if offset:
+                    values = values.astype(np.int32) - offset
+                summary["histogram"] = np.bincount(
+                    values, minlength=2 ** (8 * data.dtype.itemsize)
+                )
+            return summary
+
+        summaries = parallel.run_tasks(
+            summarize_chunk,
+            parallel.get_chunks(data.shape, data.itemsize),
+            self.workers,
+        )
+        # merge the chunks with the parallel algorithm of Chan et al.,
+        # no cancellation between large squared values
+        count, mean, m2 = 0, 0.0, 0.0
+        for s in summaries:
+            if s["count"] == 0:
+                continue
+            total = count + s["count"]
+            delta = s["mean"] - mean
+            mean += delta * s["count"] / total
+            m2 += s["m2"] + delta**2 * count * s["count"] / total
+            count = total
+        summary = {"count": count}
+        if count == 0:
+            summary.update(min=np.nan, max=np.nan, mean=np.nan, std=np.nan)
+        else:
+            summary.update(
+                min=min(s["min"] for s in summaries).item(),
+                max=max(s["max"] for s in summaries).item(),
+                mean=float(mean),
+                std=float(np.sqrt(m2 / count)),
+            )
+        if exact:
+            counts = sum(s["histogram"] for s in summaries)
+            values = np.arange(len(counts)) + offset
+            # keep the bins in [min, max]
+            kept = []
+            if count:
+                kept = slice(summary["min"] - offset, summary["max"] - offset + 1)
+            self._histogram = counts[kept], values[kept].astype(np.float64), True
+        return summary
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def histogram(self) -> tuple:
+        """
+        get the histogram of the data, computed once
+
+        Return
+        ------
+        counts: np.ndarray
+            number of values in each bin
+        centers: np.ndarray
+            value at the center of each bin
+        exact: bool
+            True if each bin is a single value
+
+        """
+        with self._lock:
+            # the exact histogram is computed with the summary
+            self.summarize()
+            if self._histogram is None:
+                self._histogram = self._compute_histogram()
+        return self._histogram
+
+    def _compute_histogram(self) -> tuple:
+        if self.count == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0), False
+        # integers with a small range get one bin by value
+        exact = self.dtype.kind in "iu" and self.max - self.min < BINS
+        if exact:
+            bins = self.max - self.min + 1
+            value_range = (self.min - 0.5, self.max + 0.5)
+        else:
+            bins = BINS if self.max > self.min else 1
+            value_range = (self.min, self.max if self.max > self.min else self.min + 1)
+
+        def count(chunk):
+            chunk = self.data[chunk]
+            if chunk.dtype.kind == "f":
+                chunk = chunk[np.isfinite(chunk)]
+            return np.histogram(chunk, bins, value_range)[0]
+
+        chunks = parallel.get_chunks(self.shape, self.dtype.itemsize)
+        counts = sum(parallel.run_tasks(count, chunks, self.workers))
+        if exact:
+            return counts, np.arange(self.min, self.max + 1, dtype=np.float64), True
+        edges = np.linspace(*value_range, bins + 1)
+        return counts, (edges[:-1] + edges[1:]) / 2, False
+
+    def percentile(self, q: float) -> float:
+        """
+        get the value under which q percent of the data are, exact for data
+        with an exact histogram, else interpolated inside a bin
+
+        Parameters
+        ----------
+        q: float
+            in [0, 100]
+
+        """
+        counts, centers, exact = self.histogram()
+        if self.count == 0:
+            return np.nan
+        cumulative = np.cumsum(counts)
+        target = max(np.ceil(q / 100 * self.count), 1)
+        index = min(np.searchsorted(cumulative, target), len(counts) - 1)
+        if exact:
+            return centers[index].item()
+        if q <= 0 or q >= 100:
+            return self.min if q <= 0 else self.max
+        # values of a bin are assumed evenly spread in the bin
+        width = (self.max - self.min) / len(counts)
+        rank = target - (cumulative[index] - counts[index]) - 0.5
+        fraction = rank / counts[index]
+        return float(self.min + (index + fraction) * width)
+
+    def median(self) -> float:
+        """
+        get the median, exact for data with an exact histogram (mean of the
+        two middle values for an even count), else interpolated inside a bin
+        """
+        counts, centers, exact = self.histogram()
+        if self.count == 0 or not exact:
+            return self.percentile(50)
+        ranks = [(self.count + 1) // 2, self.count // 2 + 1]
+        return float(np.mean(centers[np.searchsorted(np.cumsum(counts), ranks)]))
+
+    def otsu(self) -> float:
+        """
+        get the threshold maximizing the variance between the values above
+        and below it (Otsu's method), from the histogram
+        """
+        counts, centers, _ = self.histogram()
+        if len(counts) < 2:
+            return self.min
+        weights = counts * centers
+        below = np.cumsum(counts)[:-1].astype(np.float64)
+        above = self.count - below
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_below = np.cumsum(weights)[:-1] / below
+            mean_above = np.cumsum(weights[::-1])[-2::-1] / above
+            variance = below * above * (mean_below - mean_above) ** 2
+        return centers[np.nanargmax(variance)].item()
+
+    def get(self, info: str) -> float:
+        """
+        get a statistic
+
+        Parameters
+        ----------
+        info: {'min', 'max', 'mean', 'std', 'median'}
+
+        """
+        if info == "median":
+            return self.median()
+        return getattr(self, info)
@@ -5,6 +5,14 @@ class ImageInfo(Enum):
     MIN = "min"
     MAX = "max"
     MEAN = "mean"
+    STD = "std"
+    MEDIAN = "median"
+
+
+class ThresholdMethod(Enum):
+    VALUE = "value"
+    PERCENTILE = "percentile"
+    OTSU = "otsu"
 
 
 class MorphoOperation(Enum):
@@ -12,6 +20,10 @@ class MorphoOperation(Enum):
     DILATION = "dilation"
     OPENING = "opening"
     CLOSING = "closing"
+    BINARY_EROSION = "binary_erosion"
+    BINARY_DILATION = "binary_dilation"
+    BINARY_OPENING = "binary_opening"
+    BINARY_CLOSING = "binary_closing"
 
 
 class MathOperation(Enum):
@@ -0,0 +1,582 @@
+import argparse
+import copy
+import csv
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from src import DEFAULT
+from src.model.model import Model
+
+
+def get_checked(parameters: dict, names: list[str]) -> str:
+    """
+    get the first checked name among names, as utils.get_checked does with widgets
+
+    Parameters
+    ----------
+    parameters: dict
+        {widget name: value}
+    names: list of str
+
+    """
+    for name in names:
+        if parameters.get(name):
+            return name
+    return None
+
+
+def get_morpho_operation(parameters: dict) -> str:
+    operation = get_checked(parameters, ["erosion", "dilation", "opening", "closing"])
+    if parameters.get("binary"):
+        operation = "binary_" + operation
+    return operation
+
+
+# for each module type: model method and function building its arguments
+# from the module parameters and the results of its parents
+# (same arguments as the presenter call_* methods)
+MODULES = {
+    "Load": (
+        "load",
+        lambda p, inputs, workers: {
+            "path": p["path"],
+            "lazy": p.get("lazy", False),
+            "workers": workers,
+            # each subject is loaded once, the process-wide cache would keep it
+            "use_cache": False,
+        },
+    ),
+    "Save": (
+        "save",
+        lambda p, inputs, workers: {
+            "data": list(inputs.values())[0],
+            "path": p["path"],
+            "workers": workers,
+        },
+    ),
+    "ExtractChannels": (
+        "extract_channel",
+        lambda p, inputs, workers: {
+            "im": list(inputs.values())[0],
+            "channel": get_checked(p, ["red", "green", "blue"]),
+        },
+    ),
+    "GetInfo": (
+        "get_img_infos",
+        lambda p, inputs, workers: {
+            "im": list(inputs.values())[0],
+            "info": p["infos"],
+            "workers": workers,
+        },
+    ),
+    "ThresholdImage": (
+        "apply_threshold",
+        lambda p, inputs, workers: {
+            "im": list(inputs.values())[0],
+            "threshold": p["spin"],
+            "reverse": p.get("reversed", False),
+            "thresholdInPercentage": p.get("inPercentage", False),
+            "method": p.get("method", "value"),
+            "workers": workers,
+        },
+    ),
+    "SimpleOperation": (
+        "apply_operation",
+        lambda p, inputs, workers: {
+            "arr": list(inputs.values())[0],
+            "elements": float(p["value"]),
+            "operation": get_checked(p, ["add", "multiply", "subtract", "divide"]),
+            "workers": workers,
+        },
+    ),
+    "Operation": (
+        "apply_operation",
+        lambda p, inputs, workers: {
+            "arr": inputs[p["reference"]],
+            "elements": [v for k, v in inputs.items() if k != p["reference"]],
+            "operation": get_checked(p, ["add", "multiply", "subtract", "divide"]),
+            "workers": workers,
+        },
+    ),
+    "Calculator": (
+        "apply_formula",
+        lambda p, inputs, workers: {
+            "formula": p["formula"],
+            "elements": inputs,
+            "workers": workers,
+        },
+    ),
+    "MorphoBasics": (
+        "apply_basic_morpho",
+        lambda p, inputs, workers: {
+            "im": list(inputs.values())[0],
+            "size": p["size"],
+            "operation": get_morpho_operation(p),
+            "round_shape": True,
+            "workers": workers,
+        },
+    ),
+}
+
+
+def sort_modules(settings: dict) -> list[str]:
+    """
+    sort the modules of a graph so that each module comes after its parents
+
+    Parameters
+    ----------
+    settings: dict
+        the dict-like description of the graph (see QGraph.getSettings)
+
+    Return
+    ------
+    names: list of str
+
+    """
+    parents = {
+        name: list(values["state"].get("parentNames", []))
+        for name, values in settings.items()
+    }
+    for name, names in parents.items():
+        missing = set(names) - set(parents)
+        if missing:
+            raise ValueError(
+                "module '{}' has unknown parents {}".format(name, sorted(missing))
+            )
+    ordered, done = [], set()
+    while len(ordered) < len(parents):
+        ready = [n for n in parents if n not in done and done.issuperset(parents[n])]
+        if not ready:
+            raise ValueError(
+                "cycle between modules {}".format(sorted(set(parents) - done))
+            )
+        ordered += ready
+        done.update(ready)
+    return ordered
+
+
+class Pipeline:
+    """
+    execute a graph saved as .iag file without the interface, each module is
+    executed with the Model method used by the presenter
+
+    Parameters
+    ----------
+    settings: dict
+        the dict-like description of the graph (see QGraph.getSettings)
+    model: Model, default=None
+    workers: int, default=None
+        number of threads used by the model methods,
+        if None use DEFAULT["workers"] or the number of cpus
+
+    """
+
+    def __init__(self, settings: dict, model: Model = None, workers: int = None):
+        self.settings = settings
+        self.model = Model() if model is None else model
+        self.workers = workers if workers is not None else DEFAULT.get("workers")
+        self.order = sort_modules(settings)
+        self.results = {}
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs):
+        with open(path, "r") as fp:
+            return cls(json.load(fp), **kwargs)
+
+    def get_parent_names(self, name: str) -> list[str]:
+        return self.settings[name]["state"].get("parentNames", [])
+
+    def get_call(self, name: str):
+        """
+        get the model method and its arguments to execute a module
+
+        Return
+        ------
+        function: function
+        args: dict
+
+        """
+        values = self.settings[name]
+        module_type = values["state"]["moduleType"]
+        if module_type not in MODULES:
+            raise ValueError("module type '{}' cannot be executed".format(module_type))
+        method, build_args = MODULES[module_type]
+        inputs = {p: self.results[p] for p in self.get_parent_names(name)}
+        args = build_args(values.get("parameters", {}), inputs, self.workers)
+        return getattr(self.model, method), args
+
+    def run_module(self, name: str):
+        """
+        execute a module whose parents have a result, errors are returned as
+        in the interface
+        """
+        try:
+            function, args = self.get_call(name)
+            return function(**args)
+        except Exception as e:
+            return e
+
+    def run(self, names: list[str] = None, callback=None) -> dict:
+        """
+        execute modules in topological order, modules with a failed parent
+        are not executed
+
+        Parameters
+        ----------
+        names: list of str, default=None
+            modules to execute with their ancestors, if None execute all modules
+        callback: function, default=None
+            called as callback(name, result, duration) after each module
+
+        Return
+        ------
+        results: dict
+            {module name: result or Exception}
+
+        """
+        needed = set(self.order if names is None else names)
+        for name in reversed(self.order):
+            if name in needed:
+                needed.update(self.get_parent_names(name))
+
+        for name in self.order:
+            if name not in needed or name in self.results:
+                continue
+            parents = [self.results.get(p) for p in self.get_parent_names(name)]
+            if any(isinstance(p, Exception) for p in parents):
+                result = RuntimeError("a parent module failed")
+                duration = 0
+            else:
+                start = time.perf_counter()
+                result = self.run_module(name)
+                duration = time.perf_counter() - start
+            self.results[name] = result
+            if callback is not None:
+                callback(name, result, duration)
+        return self.results
+
+
+def get_inputs(patterns: list[str]) -> list[str]:
+    """
+    expand a list of paths and glob patterns into a sorted list of inputs,
+    without duplicates
+    """
+    inputs = []
+    for pattern in patterns:
+        paths = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        inputs += [p for p in paths if p not in inputs]
+    return inputs
+
+
+def get_subject(path: str) -> str:
+    """
+    get the subject name of an input: its file name without extensions
+    """
+    name = os.path.basename(os.path.normpath(path))
+    return name.split(".")[0] or name
+
+
+def get_subject_settings(
+    settings: dict, load: list[str], path: str, index: int
+) -> dict:
+    """
+    get the settings of a graph executed on one subject: the Load modules read
+    the subject input and the Save paths are formatted with {subject} and
+    {index}. Save paths without {subject} are written in a subject directory
+
+    Parameters
+    ----------
+    settings: dict
+    load: list of str
+        names of the Load modules reading the subject input
+    path: str
+        subject input
+    index: int
+        subject index in the batch
+
+    """
+    settings = copy.deepcopy(settings)
+    subject = get_subject(path)
+    for name in load:
+        settings[name]["parameters"]["path"] = path
+    for values in settings.values():
+        if values["state"]["moduleType"] == "Save":
+            template = values["parameters"]["path"]
+            if "{subject}" not in template:
+                directory, filename = os.path.split(template)
+                template = os.path.join(directory, "{subject}", filename)
+            values["parameters"]["path"] = template.format(subject=subject, index=index)
+    return settings
+
+
+def get_peak_memory() -> int:
+    """
+    get the peak memory used by the current process (bytes), 0 if unknown
+    """
+    try:
+        import resource
+
+        # kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        import psutil
+
+        return getattr(psutil.Process().memory_info(), "peak_wset", 0)
+
+
+def run_subject(
+    settings: dict, load: list[str], path: str, index: int, workers: int = None
+) -> dict:
+    """
+    execute a graph on one subject, only a report is returned so that results
+    are released with the subject
+
+    Return
+    ------
+    report: dict
+        index, subject, input, status ('ok' or 'failed'), duration (s),
+        errors ({module name: message}), outputs (saved paths), peak_memory
+
+    """
+    start = time.perf_counter()
+    report = {"index": index, "subject": get_subject(path), "input": path}
+    try:
+        settings = get_subject_settings(settings, load, path, index)
+        for values in settings.values():
+            if values["state"]["moduleType"] == "Save":
+                directory = os.path.dirname(values["parameters"]["path"])
+                os.makedirs(directory or ".", exist_ok=True)
+        results = Pipeline(settings, workers=workers).run()
+        report["errors"] = {
+            name: describe(result)
+            for name, result in results.items()
+            if isinstance(result, Exception)
+        }
+        report["outputs"] = [
+            values["parameters"]["path"]
+            for name, values in settings.items()
+            if values["state"]["moduleType"] == "Save"
+            and not isinstance(results.get(name), Exception)
+        ]
+    except Exception as e:
+        report["errors"], report["outputs"] = {"graph": describe(e)}, []
+    report["status"] = "failed" if report["errors"] else "ok"
+    report["duration"] = time.perf_counter() - start
+    report["peak_memory"] = get_peak_memory()
+    return report
+
+
+def run_batch(
+    settings: dict,
+    inputs: list[str],
+    load: list[str] = None,
+    processes: int = None,
+    workers: int = None,
+    memory: float = None,
+    callback=None,
+) -> list[dict]:
+    """
+    execute a graph on each input concurrently on a process pool
+
+    Parameters
+    ----------
+    settings: dict
+        the dict-like description of the graph (see QGraph.getSettings)
+    inputs: list of str
+        subject inputs (paths of files or directories of images)
+    load: list of str, default=None
+        names of the Load modules reading the subject inputs,
+        if None the graph must contain a single Load module
+    processes: int, default=None
+        number of subjects executed at the same time,
+        if None use DEFAULT["batch_processes"] or the number of cpus
+    workers: int, default=None
+        number of threads of each subject, if None share the cpus
+        between processes
+    memory: float, default=None
+        memory budget (GB), if set the first subject is executed alone to
+        measure its peak memory and the number of processes is limited to
+        fit in the budget
+    callback: function, default=None
+        called with the report of each subject when it is done
+
+    Return
+    ------
+    reports: list of dict
+        reports of the subjects in the order of inputs (see run_subject)
+
+    """
+    sort_modules(settings)
+    if load is None:
+        load = [n for n, v in settings.items() if v["state"]["moduleType"] == "Load"]
+        if len(load) != 1:
+            raise ValueError("the Load modules reading the inputs must be specified")
+    if processes is None:
+        processes = DEFAULT.get("batch_processes") or os.cpu_count() or 1
+    processes = max(1, min(processes, len(inputs)))
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 1) // processes)
+
+    reports = [None] * len(inputs)
+    tasks = list(enumerate(inputs))
+    with ProcessPoolExecutor(processes) as executor:
+
+        def submit(index, path):
+            return executor.submit(run_subject, settings, load, path, index, workers)
+
+        if memory is not None and tasks:
+            # the pool is filled once the memory of one subject is known
+            index, path = tasks.pop(0)
+            reports[index] = submit(index, path).result()
+            peak = max(reports[index]["peak_memory"], 1)
+            processes = max(1, min(processes, int(memory * 2**30 // peak)))
+            if callback is not None:
+                callback(reports[index])
+
+        # at most 'processes' subjects in memory at the same time
+        pending = set()
+        while tasks or pending:
+            while tasks and len(pending) < processes:
+                pending.add(submit(*tasks.pop(0)))
+            done = next(as_completed(pending))
+            pending.remove(done)
+            report = done.result()
+            reports[report["index"]] = report
+            if callback is not None:
+                callback(report)
+    return reports
+
+
+def write_report(reports: list[dict], path: str):
+    """
+    write the reports of a batch as csv
+    """
+    columns = ["index", "subject", "input", "status", "duration", "peak_memory"]
+    with open(path, "w", newline="") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(columns + ["outputs", "errors"])
+        for report in reports:
+            errors = ["{}: {}".format(*e) for e in report["errors"].items()]
+            writer.writerow(
+                [report[c] for c in columns]
+                + [";".join(report["outputs"]), ";".join(errors)]
+            )
+
+
+def describe(result) -> str:
+    """
+    get a one-line description of a module result
+    """
+    if isinstance(result, Exception):
+        message = (str(result).splitlines() or [""])[0]
+        return "failed: {}: {}".format(type(result).__name__, message)
+    if isinstance(result, np.ndarray):
+        return "array {} {}".format(tuple(result.shape), result.dtype)
+    if result is None:
+        return "done"
+    return str(result)
+
+
+def main(argv: list[str] = None) -> int:
+    """
+    command line entry point, execute a .iag graph file once or on a batch
+    of inputs
+
+    Return
+    ------
+    status: int
+        0 if every module succeeded, else 1
+
+    """
+    parser = argparse.ArgumentParser(
+        description="execute a Francis graph (.iag file) without interface"
+    )
+    parser.add_argument("graph", help="path to the .iag file")
+    parser.add_argument(
+        "-m",
+        "--modules",
+        nargs="+",
+        help="modules to execute with their ancestors (default: all)",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, help="number of threads used by each module"
+    )
+    batch = parser.add_argument_group(
+        "batch mode",
+        "execute the graph on each input, Save paths can contain {subject} "
+        "(input name without extension) and {index}, else outputs are written "
+        "in a subject directory",
+    )
+    batch.add_argument(
+        "-b", "--batch", nargs="+", metavar="INPUT", help="input paths or patterns"
+    )
+    batch.add_argument(
+        "-l",
+        "--load",
+        nargs="+",
+        help="Load modules reading the inputs (default: the only Load module)",
+    )
+    batch.add_argument(
+        "-p", "--processes", type=int, help="number of subjects run at the same time"
+    )
+    batch.add_argument(
+        "--memory", type=float, help="memory budget in GB, limits --processes"
+    )
+    batch.add_argument("-r", "--report", help="path of the csv report")
+    args = parser.parse_args(argv)
+
+    if args.batch:
+        return run_batch_command(args)
+
+    def report(name, result, duration):
+        print("{0} ({1:.2f}s): {2}".format(name, duration, describe(result)))
+
+    pipeline = Pipeline.from_file(args.graph, workers=args.workers)
+    results = pipeline.run(args.modules, callback=report)
+    return int(any(isinstance(r, Exception) for r in results.values()))
+
+
+def run_batch_command(args) -> int:
+    """
+    execute the batch mode of the command line and print its report
+    """
+    with open(args.graph, "r") as fp:
+        settings = json.load(fp)
+    inputs = get_inputs(args.batch)
+
+    def report(subject):
+        print(
+            "[{0}/{1}] {subject} {status} ({duration:.2f}s)".format(
+                subject["index"] + 1, len(inputs), **subject
+            )
+        )
+        for name, error in subject["errors"].items():
+            print("    {}: {}".format(name, error))
+
+    start = time.perf_counter()
+    reports = run_batch(
+        settings,
+        inputs,
+        args.load,
+        args.processes,
+        args.workers,
+        args.memory,
+        callback=report,
+    )
+    duration = time.perf_counter() - start
+    failed = [r["subject"] for r in reports if r["status"] != "ok"]
+    print(
+        "{0} subjects in {1:.1f}s ({2:.1f} subjects/min), {3} failed".format(
+            len(reports), duration, 60 * len(reports) / max(duration, 1e-9), len(failed)
+        )
+    )
+    if failed:
+        print("failed: " + ", ".join(failed))
+    if args.report:
+        write_report(reports, args.report)
+    return int(bool(failed))
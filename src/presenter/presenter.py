@@ -4,13 +4,20 @@ import shutil
 import numpy as np
 from PyQt5 import QtWidgets
 
-from src import RSC_DIR, TMP_DIR
-from src.model.model import Model
+from src import DEFAULT, RSC_DIR, TMP_DIR
+from src.model.cache import LOAD_CACHE, RESULT_CACHE
+from src.model import parallel
+from src.model.model import Model, get_slice_paths
 from src.presenter import utils
+from src.presenter.scheduler import Scheduler
 from src.presenter.utils import ThreadMode
+from src.view.graph import QGraph
 from src.view.graph_bricks import QGraphicsModule
 from src.view.view import View
 
+# modules with side effects, always run
+UNCACHED_MODULES = ["Save"]
+
 
 class Presenter:
     """
@@ -32,10 +39,15 @@ class Presenter:
         self.threading_enabled = True
         self._data_dir = os.path.join(RSC_DIR, "data")
         self._out_dir = os.path.join(RSC_DIR, "data", "out")
+        self.schedulers = {}
+        self.result_cache = RESULT_CACHE
         self._view.moduleAdded.connect(lambda m: self.init_module_connections(m))
         self._view.closed.connect(self.terminateProcesses)
-        self._view.restoreTabs()
+        self._view.runRequested.connect(self.run_graph)
+        self._view.fileOpened.connect(self.restore_cached_results)
+        # results may be spilled in TMP_DIR as soon as the tabs are restored
         self.init_tmp_dir()
+        self._view.restoreTabs()
 
     def init_tmp_dir(self):
         if os.path.exists(TMP_DIR):
@@ -51,6 +63,109 @@ class Presenter:
             for module in graph.modules.values():
                 if module.runner:
                     module.runner.terminate()
+        utils.WORKER_POOL.close()
+
+    def get_scheduler(self, graph: QGraph) -> Scheduler:
+        """
+        get the scheduler running the modules of a graph
+        """
+        if graph not in self.schedulers:
+
+            def start(module):
+                function = self._view.getParameters(module.type)["function"]
+                getattr(self, function)(module)
+
+            self.schedulers[graph] = Scheduler(start, self.get_fingerprint)
+        return self.schedulers[graph]
+
+    def run_graph(self, graph: QGraph):
+        """
+        run the modules of a graph whose result is stale, independent branches
+        run at the same time and up to date results are reused
+        """
+        scheduler = self.get_scheduler(graph)
+        # every module is checked once for the whole graph
+        memo = {}
+        for module in list(graph.modules.values()):
+            scheduler.request(module, force=False, memo=memo)
+
+    def get_fingerprint(self, module: QGraphicsModule) -> str:
+        """
+        get the fingerprint of the current parameters and inputs of a module,
+        the inputs are the results stored for its parents,
+        see utils.get_fingerprint
+        """
+        parameters = module.getSettings()["parameters"]
+        files = None
+        if module.type == "Load":
+            path = module.parameters.path.text()
+            # same files as the load cache
+            files = get_slice_paths(path) or [path]
+        parents = [module.graph.getFingerprint(p.name) for p in module.parents]
+        return utils.get_fingerprint(module.type, parameters, parents, files)
+
+    def get_statistics(self, output):
+        """
+        get the statistics of a result, called in the thread of its runner.
+        Memory-mapped results are only read when their statistics are used
+        """
+        lazy = isinstance(output, np.memmap)
+        return self._model.get_statistics(output, DEFAULT.get("workers"), lazy)
+
+    def finish_output(self, module: QGraphicsModule, output):
+        """
+        write the result of a module in the on-disk cache and get its
+        statistics, called in the thread of its runner before post_manager
+        """
+        if self.result_cache is not None and module.type not in UNCACHED_MODULES:
+            self.result_cache.put(module.fingerprint, output)
+        return self.get_statistics(output)
+
+    def get_cached_result(self, module: QGraphicsModule):
+        """
+        get the result of a module from the on-disk cache, None if the cache
+        is disabled or does not contain the fingerprint of the module
+        """
+        if self.result_cache is None or module.type in UNCACHED_MODULES:
+            return None
+        return self.result_cache.get(module.fingerprint)
+
+    def restore_cached_results(self, graph: QGraph):
+        """
+        show the cached results of the modules of an opened graph, parents
+        first so that their fingerprint is known by their childs
+        """
+        restored = set()
+
+        def restore(module):
+            if module in restored:
+                return
+            restored.add(module)
+            for parent in module.parents:
+                restore(parent)
+            module.fingerprint = self.get_fingerprint(module)
+            cached = self.get_cached_result(module)
+            if cached is not None:
+                self.post_manager(module, cached)
+
+        for module in list(graph.modules.values()):
+            restore(module)
+
+    def update_stale_states(self, module: QGraphicsModule, memo: dict = None):
+        """
+        clear the 'valid' state of a module and of its descendants when their
+        result is stale, memo is shared with Scheduler.isStale
+        """
+        if memo is None:
+            memo = {}
+        elif module in memo:
+            # already visited through another parent
+            return
+        scheduler = self.get_scheduler(module.graph)
+        if scheduler.isStale(module, memo) and module.state == "valid":
+            module.setState()
+        for child in module.childs:
+            self.update_stale_states(child, memo)
 
     # --------------------- PRIOR  AND POST FUNCTION CALL ---------------------#
     def prior_manager(
@@ -71,21 +186,23 @@ class Presenter:
 
         """
 
+        # parameters may change during the process
+        module.fingerprint = self.get_fingerprint(module)
+
+        # reuse a result computed in a previous session
+        cached = self.get_cached_result(module)
+        if cached is not None:
+            self.post_manager(module, cached)
+            return False
+
         # start loading
         if thread_mode == 1:
             module.setState("loading", suspendable=False)
         elif thread_mode == 2:
             module.setState("loading")
-
-        # store signal propagation
-        for parent in module.parents:
-            if module.getData(parent.name) is None:
-                parent.propagation_child = module
-                parent.play.clicked.emit()
-                return False
         return True
 
-    def post_manager(self, module: QGraphicsModule, output):
+    def post_manager(self, module: QGraphicsModule, output, statistics=None):
         """
         This method is called by the manager after the model method process
         It manage the output of the model method based on the output type
@@ -94,10 +211,29 @@ class Presenter:
         ----------
         module: QGraphicsModule
         output: Exception, str, pd.DataFrame, np.array, ...
+        statistics: stats.Statistics, default=None
+            statistics of output computed with it, if None they are computed
+            the first time they are used
 
         """
+        if isinstance(output, parallel.Cancelled):
+            # stopped by the user, the previous result is kept
+            module.setState()
+            self.get_scheduler(module.graph).done(module, updated=False)
+            return
         if output is not None:
-            module.graph.storeData(module.name, output)
+            # computed once, used by the renderer and the following modules
+            if statistics is None:
+                statistics = self._model.get_statistics(
+                    output, DEFAULT.get("workers"), lazy=True
+                )
+            module.graph.storeData(
+                module.name,
+                output,
+                statistics,
+                module.fingerprint,
+                shared=LOAD_CACHE.holds(output),
+            )
         if output is None:
             module.setState()
         elif isinstance(output, Exception):
@@ -106,11 +242,8 @@ class Presenter:
             module.setState("valid")
         module.showResult(output)
 
-        # retropropagate signal between modules
-        if module.propagation_child is not None:
-            if not isinstance(output, Exception):
-                module.propagation_child.play.clicked.emit()
-            module.propagation_child = None
+        # start the modules waiting for this one (terminated if output is None)
+        self.get_scheduler(module.graph).done(module, updated=output is not None)
 
     # ------------------------------ CONNECTIONS ------------------------------#
     def init_module_connections(self, module: QGraphicsModule):
@@ -123,9 +256,6 @@ class Presenter:
         module: QGraphicsModule
 
         """
-        parameters = self._view.getParameters(module.type)
-        activation_function = eval("self." + parameters["function"])
-
         # connect start, pause, stop buttons
         def play():
             if module.state == "pause":
@@ -133,7 +263,7 @@ class Presenter:
                     module.runner.resume()
                 module.setState("loading")
             elif self._model is not None:
-                activation_function(module)
+                self.get_scheduler(module.graph).request(module)
 
         def pause():
             if module.runner:
@@ -141,12 +271,18 @@ class Presenter:
             module.setState("pause")
 
         def stop():
-            if module.runner:
+            if module.runner and module.runner.cancellable:
+                # the model method stops between two blocks
+                module.runner.cancel()
+            elif module.runner:
                 module.runner.terminate()
+            else:
+                self.get_scheduler(module.graph).cancel(module)
 
         module.play.clicked.connect(play)
         module.pause.clicked.connect(pause)
         module.stop.clicked.connect(stop)
+        module.modified.connect(lambda: self.update_stale_states(module))
 
         self.init_module_custom_connections(module)
 
@@ -194,6 +330,16 @@ class Presenter:
                 if isinstance(button, QtWidgets.QPushButton):
                     fill_formula(button, name)
 
+        elif module.type == "ThresholdImage":
+
+            def updateMethod(method):
+                module.parameters.spin.setEnabled(method != "otsu")
+                module.parameters.inPercentage.setEnabled(method == "value")
+                maximum = 100 if method == "percentile" else 256
+                module.parameters.spin.setMaximum(maximum)
+
+            module.parameters.method.currentTextChanged.connect(updateMethod)
+
         elif module.type == "Operation":
             for rb in [module.parameters.add, module.parameters.multiply]:
                 rb.clicked.connect(
@@ -229,7 +375,12 @@ class Presenter:
 
         # init extensions and
         if isinstance(result, np.ndarray):
-            extensions = ["PNG (*.png)", "NIFTI (*.nii)", "JPEG (*.jpg)"]
+            extensions = [
+                "PNG (*.png)",
+                "NIFTI (*.nii)",
+                "JPEG (*.jpg)",
+                "NUMPY (*.npy)",
+            ]
             dim = len(result.shape)
             if dim == 2:
                 init_extension = extensions[0]
@@ -271,7 +422,7 @@ class Presenter:
             module.graph,
             "Select a file...",
             self._data_dir,
-            filter="*.nii.gz *.nii *.png *.jpg *.txt *.pkl",
+            filter="*.nii.gz *.nii *.png *.jpg *.txt *.pkl *.npy *.npz",
         )
         if ok:
             module.parameters.path.setText(filename)
@@ -288,16 +439,22 @@ class Presenter:
         args = {
             "data": module.getData(parent_name),
             "path": module.parameters.path.text(),
+            "workers": DEFAULT.get("workers"),
         }
         return function, args
 
-    @utils.manager(2)
+    @utils.manager(1)
     def call_load(self, module: QGraphicsModule):
         """
-        load any type of data
+        load any type of data, loading is run inside a thread so that lazy
+        (memory-mapped) data is not pickled back from a subprocess
         """
         function = self._model.load
-        args = {"path": module.parameters.path.text()}
+        args = {
+            "path": module.parameters.path.text(),
+            "lazy": module.parameters.lazy.isChecked(),
+            "workers": DEFAULT.get("workers"),
+        }
         return function, args
 
     @utils.manager(2)
@@ -313,17 +470,20 @@ class Presenter:
         }
         return function, args
 
-    @utils.manager(2)
+    @utils.manager(1)
     def call_get_img_infos(self, module):
         """
-        get image info
+        get image info, from the statistics of the parent result if computed
         """
         parent_name = module.get_parent_name()
+        statistics = module.graph.getStatistics(parent_name)
 
         function = self._model.get_img_infos
         args = {
-            "im": module.getData(parent_name),
+            "im": module.getData(parent_name) if statistics is None else None,
             "info": module.parameters.infos.currentText(),
+            "statistics": statistics,
+            "workers": DEFAULT.get("workers"),
         }
         return function, args
 
@@ -341,6 +501,9 @@ class Presenter:
             "threshold": module.parameters.spin.value(),
             "reverse": module.parameters.reversed.isChecked(),
             "thresholdInPercentage": module.parameters.inPercentage.isChecked(),
+            "method": module.parameters.method.currentText(),
+            "statistics": module.graph.getStatistics(parent_name),
+            "workers": DEFAULT.get("workers"),
         }
         return function, args
 
@@ -360,6 +523,7 @@ class Presenter:
             "operation": utils.get_checked(
                 module.parameters, ["add", "multiply", "subtract", "divide"]
             ),
+            "workers": DEFAULT.get("workers"),
         }
         return function, args
 
@@ -377,6 +541,7 @@ class Presenter:
             "operation": utils.get_checked(
                 module.parameters, ["add", "multiply", "subtract", "divide"]
             ),
+            "workers": DEFAULT.get("workers"),
         }
         return function, args
 
@@ -390,6 +555,7 @@ class Presenter:
         args = {
             "formula": module.parameters.formula.text(),
             "elements": {name: module.getData(name) for name in parent_names},
+            "workers": DEFAULT.get("workers"),
         }
         return function, args
 
@@ -412,5 +578,6 @@ class Presenter:
             "size": module.parameters.size.value(),
             "operation": operation,
             "round_shape": True,
+            "workers": DEFAULT.get("workers"),
         }
         return function, args
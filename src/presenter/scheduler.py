@@ -0,0 +1,144 @@
+import os
+
+from src import DEFAULT
+from src.view.graph_bricks import QGraphicsModule
+
+
+class Scheduler:
+    """
+    run the modules of a graph in topological order: every module whose
+    parents have a result is started at once, up to a number of running
+    modules, and a module starts as soon as all its parents are done.
+    Parents with an up to date result are not run again
+
+    Parameters
+    ----------
+    start: function
+        called as start(module) to run a module, the presenter must call
+        'done' when the module is finished
+    fingerprint: function, default=None
+        called as fingerprint(module) to get the fingerprint of the current
+        parameters and inputs of a module (the results of its parents), a
+        result stored with another fingerprint is stale. If None, every
+        result is up to date
+    max_running: int, default=None
+        maximum number of modules running at the same time,
+        if None use DEFAULT["max_parallel_modules"] or the number of cpus
+
+    """
+
+    def __init__(self, start, fingerprint=None, max_running: int = None):
+        self.start = start
+        self.fingerprint = fingerprint
+        if max_running is None:
+            max_running = DEFAULT.get("max_parallel_modules") or os.cpu_count() or 1
+        self.max_running = max(1, max_running)
+        # modules waiting for their parents, in request order
+        self.pending = []
+        self.running = set()
+
+    def hasResult(self, module: QGraphicsModule) -> bool:
+        result = module.graph.resultStack.get(module.name)
+        return result is not None and not isinstance(result, Exception)
+
+    def isStale(self, module: QGraphicsModule, memo: dict = None) -> bool:
+        """
+        True if the module has no valid result, if its result was computed
+        with other parameters or inputs or if a parent is stale
+
+        Parameters
+        ----------
+        module: QGraphicsModule
+        memo: dict, default=None
+            staleness of the modules already checked, share it between the
+            calls of a same pass so that every module is checked once
+
+        """
+        if memo is None:
+            memo = {}
+        if module not in memo:
+            if not self.hasResult(module):
+                memo[module] = True
+            elif self.fingerprint is None:
+                memo[module] = False
+            elif module.graph.getFingerprint(module.name) != self.fingerprint(module):
+                memo[module] = True
+            else:
+                memo[module] = any(self.isStale(p, memo) for p in module.parents)
+        return memo[module]
+
+    def request(self, module: QGraphicsModule, force: bool = True, memo: dict = None):
+        """
+        run a module after its stale parents
+
+        Parameters
+        ----------
+        module: QGraphicsModule
+        force: bool, default=True
+            if False, do not run the module if its result is up to date
+        memo: dict, default=None
+            see isStale
+
+        """
+        if memo is None:
+            memo = {}
+        if module in self.pending or module in self.running:
+            return
+        if not force and not self.isStale(module, memo):
+            return
+        for parent in module.parents:
+            self.request(parent, force=False, memo=memo)
+        self.pending.append(module)
+        module.setState("loading")
+        self.schedule()
+
+    def isReady(self, module: QGraphicsModule) -> bool:
+        return not any(p in self.pending or p in self.running for p in module.parents)
+
+    def schedule(self):
+        """
+        start the ready modules while there are free workers
+        """
+        while len(self.running) < self.max_running:
+            module = next((m for m in self.pending if self.isReady(m)), None)
+            if module is None:
+                return
+            self.pending.remove(module)
+            if module.name not in module.graph.modules:
+                # deleted while waiting
+                continue
+            if not all(self.hasResult(p) for p in module.parents):
+                # a parent failed or was stopped
+                module.setState()
+                continue
+            self.running.add(module)
+            self.start(module)
+
+    def cancel(self, module: QGraphicsModule):
+        """
+        remove a waiting module and the waiting modules depending on it
+        """
+        if module in self.pending:
+            self.pending.remove(module)
+            module.setState()
+        for child in module.childs:
+            self.cancel(child)
+
+    def done(self, module: QGraphicsModule, updated: bool = True):
+        """
+        called when a module is finished, start the modules waiting for it
+
+        Parameters
+        ----------
+        module: QGraphicsModule
+        updated: bool, default=True
+            False if the module ended without a new result (stopped), its
+            previous result is outdated and the modules waiting for it are
+            cancelled
+
+        """
+        self.running.discard(module)
+        if not updated:
+            for child in module.childs:
+                self.cancel(child)
+        self.schedule()
@@ -1,16 +1,332 @@
 import functools
+import hashlib
+import inspect
+import io
+import json
+import mmap
 import os
 import pickle
+import shutil
+import sys
+import threading
 import traceback
+import weakref
 from datetime import datetime
 from enum import Enum
-from multiprocessing import Process
+from multiprocessing import Pipe, Process, RawValue, resource_tracker, shared_memory
 
+import numpy as np
 import psutil
 from PyQt5 import QtCore
 from PyQt5.QtWidgets import QWidget
 
-from src import TMP_DIR
+from src import DEFAULT, TMP_DIR
+from src.model import parallel
+
+
+# arrays smaller than this are pickled with their values
+SHARED_BYTES = 2**16
+
+# {id of a mapping: (name, address)} of the shared memory owned by this process
+_mappings = {}
+# {id of an array: [weak reference, mapping, number of runs using it]} of the
+# arrays copied in shared memory
+_copies = {}
+_shared_lock = threading.RLock()
+# held while resource_tracker.register is replaced, see map_shared_memory
+_tracker_lock = threading.Lock()
+
+
+def map_shared_memory(
+    name: str = None, size: int = 0, track: bool = True
+) -> tuple[shared_memory.SharedMemory, mmap.mmap]:
+    """
+    create (if name is None) or open a shared memory and get its mapping
+
+    Every shared memory of francis goes through this function, it keeps the
+    uses of CPython internals in one place:
+    - before python 3.13 SharedMemory has no 'track' argument, the memory is
+      not registered by replacing resource_tracker.register for the time of
+      the call. Registrations are serialized by a lock so that another
+      thread never calls the replacement
+    - SharedMemory.close closes its mapping, which fails while arrays use it.
+      The mapping is taken from the private '_mmap' attribute before closing
+      the handle, the arrays then keep it alive
+
+    Parameters
+    ----------
+    name: str, default=None
+        name of an existing shared memory, if None a new one is created
+    size: int, default=0
+        size of the created shared memory
+    track: bool, default=True
+        if False, the resource tracker of this process does not unlink the
+        memory at exit (another process owns it)
+
+    Return
+    ------
+    shm: shared_memory.SharedMemory
+        closed, only used for its name and to unlink the memory
+    mapping: mmap.mmap
+
+    """
+    options = {"name": name, "create": name is None, "size": size}
+    if not track and sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(**options, track=False)
+    else:
+        with _tracker_lock:
+            register = resource_tracker.register
+            if not track:
+                resource_tracker.register = lambda *args: None
+            try:
+                shm = shared_memory.SharedMemory(**options)
+            finally:
+                resource_tracker.register = register
+    mapping, shm._mmap = shm._mmap, None
+    shm.close()
+    return shm, mapping
+
+
+def own_mapping(shm: shared_memory.SharedMemory, mapping: mmap.mmap):
+    """
+    free a shared memory when its mapping and the arrays using it are
+    deleted, see map_shared_memory. Other processes can attach it by name
+    """
+    address = np.frombuffer(mapping, np.uint8).ctypes.data
+    with _shared_lock:
+        _mappings[id(mapping)] = (shm.name, address)
+    weakref.finalize(mapping, release_mapping, id(mapping), shm)
+
+
+def release_mapping(key: int, shm: shared_memory.SharedMemory):
+    with _shared_lock:
+        _mappings.pop(key, None)
+    shm.unlink()
+
+
+class SharedArray:
+    """
+    description of an array stored in shared memory or in a memory-mapped
+    file, pickled instead of the array values (see SharedPickler). The
+    receiving process maps the values without copy.
+
+    Parameters
+    ----------
+    shape: tuple
+    dtype: np.dtype
+    strides: tuple, default=None
+    offset: int, default=0
+        position of the first value in the shared memory or the file
+    name: str, default=None
+        name of the shared memory
+    path: str, default=None
+        file containing the values if name is None
+    owned: bool, default=False
+        if True, the receiving process frees the values when the array is
+        deleted (results), else the sending process does (inputs)
+
+    """
+
+    def __init__(
+        self,
+        shape: tuple,
+        dtype: np.dtype,
+        strides: tuple = None,
+        offset: int = 0,
+        name: str = None,
+        path: str = None,
+        owned: bool = False,
+    ):
+        self.shape, self.dtype, self.strides = shape, dtype, strides
+        self.offset, self.name, self.path, self.owned = offset, name, path, owned
+
+    @classmethod
+    def create(cls, array: np.ndarray, path: str):
+        """
+        copy an array in a new shared memory, or in a file if the shared
+        memory is too small, the receiving process owns the copy
+        """
+        size = max(array.nbytes, 1)
+        if not cls.fitsInSharedMemory(size):
+            np.ascontiguousarray(array).tofile(path)
+            return cls(array.shape, array.dtype, path=path, owned=True)
+        # the receiving process frees the memory
+        shm, mapping = map_shared_memory(size=size, track=False)
+        np.ndarray(array.shape, array.dtype, buffer=mapping)[...] = array
+        mapping.close()
+        return cls(array.shape, array.dtype, name=shm.name, owned=True)
+
+    @classmethod
+    def reference(cls, array: np.ndarray, copies: list = None):
+        """
+        describe an array without copying it if its values are in shared
+        memory or in a memory-mapped file, else copy them once in shared
+        memory. None if the array cannot be shared
+
+        Parameters
+        ----------
+        array: np.ndarray
+        copies: list, default=None
+            the keys of the copies used are appended, they are freed by
+            release_copies once every run using them is done. If None, a copy
+            lasts as long as the array
+
+        """
+        chain = [array]
+        while isinstance(chain[-1], np.ndarray) and chain[-1].base is not None:
+            chain.append(chain[-1].base)
+        root = chain[-1]
+        with _shared_lock:
+            for base in chain:
+                entry = _copies.get(id(base))
+                if entry is None or entry[0]() is not base:
+                    continue
+                if copies is not None:
+                    entry[2] += 1
+                    copies.append(id(base))
+                name, _ = _mappings[id(entry[1])]
+                offset = array.ctypes.data - base.ctypes.data
+                return cls(array.shape, array.dtype, array.strides, offset, name)
+            if id(root) in _mappings:
+                name, address = _mappings[id(root)]
+                offset = array.ctypes.data - address
+                return cls(array.shape, array.dtype, array.strides, offset, name)
+        if isinstance(root, mmap.mmap):
+            memmap = next((a for a in chain if isinstance(a, np.memmap)), None)
+            if memmap is None or memmap.filename is None:
+                return None
+            # the mapping starts at the allocation boundary before the offset
+            address = np.frombuffer(root, np.uint8).ctypes.data
+            start = memmap.offset - memmap.offset % mmap.ALLOCATIONGRANULARITY
+            offset = start + array.ctypes.data - address
+            path = memmap.filename
+            return cls(array.shape, array.dtype, array.strides, offset, path=path)
+        if not isinstance(root, np.ndarray) or not cls.fitsInSharedMemory(root.nbytes):
+            return None
+        if not (root.flags.c_contiguous or root.flags.f_contiguous):
+            return None
+        # copy the whole array once, its views are then sent without copy
+        shm, mapping = map_shared_memory(size=max(root.nbytes, 1))
+        values = root.ravel("K").view(np.uint8)
+        np.frombuffer(mapping, np.uint8, root.nbytes)[:] = values
+        own_mapping(shm, mapping)
+        with _shared_lock:
+            key = id(root)
+            reference = weakref.ref(root, lambda _: _copies.pop(key, None))
+            _copies[key] = [reference, mapping, 0]
+        return cls.reference(array, copies)
+
+    @staticmethod
+    def fitsInSharedMemory(size: int) -> bool:
+        if os.name != "posix":
+            # windows frees the shared memory with its last handle
+            return False
+        # writing beyond the size of /dev/shm would kill the process
+        if not os.path.isdir("/dev/shm"):
+            return True
+        return shutil.disk_usage("/dev/shm").free > size
+
+    def attach(self) -> np.ndarray:
+        """
+        get the array in the receiving process
+        """
+        if self.name is not None:
+            shm, buffer = map_shared_memory(self.name, track=self.owned)
+            if self.owned:
+                own_mapping(shm, buffer)
+        else:
+            buffer = np.memmap(self.path, np.uint8, mode="r")
+            if self.owned:
+                # kept while mapped, the array may be sent to another process
+                weakref.finalize(buffer.base, remove_file, self.path)
+        return np.ndarray(
+            self.shape, self.dtype, buffer, self.offset, self.strides
+        )
+
+
+def release_copies(keys: list):
+    """
+    free the shared memory copies used by a finished run, see
+    SharedArray.reference
+    """
+    with _shared_lock:
+        for key in keys:
+            entry = _copies.get(key)
+            if entry is not None:
+                entry[2] -= 1
+                if entry[2] <= 0:
+                    del _copies[key]
+
+
+class SharedPickler(pickle.Pickler):
+    """
+    pickler sending the large numeric arrays of any object through shared
+    memory, only their description is pickled (see SharedArray)
+
+    Parameters
+    ----------
+    file: file object
+    path: str, default=None
+        if None, arrays are referenced and stay owned by this process
+        (inputs), else they are copied and owned by the receiving process
+        (results), path is the prefix of the files used if the shared memory
+        is too small
+
+    Attributes
+    ----------
+    copies: list
+        keys of the shared memory copies of the inputs, to free with
+        release_copies once they are not used anymore
+
+    """
+
+    def __init__(self, file, path: str = None):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.path = path
+        self.count = 0
+        self.copies = []
+
+    def persistent_id(self, obj):
+        if not isinstance(obj, np.ndarray) or obj.dtype.hasobject:
+            return None
+        if obj.nbytes < SHARED_BYTES:
+            return None
+        if self.path is None:
+            return SharedArray.reference(obj, self.copies)
+        self.count += 1
+        return SharedArray.create(obj, "{}_{}".format(self.path, self.count))
+
+
+class SharedUnpickler(pickle.Unpickler):
+    """
+    unpickler of the data pickled by SharedPickler
+    """
+
+    def persistent_load(self, pid: SharedArray) -> np.ndarray:
+        return pid.attach()
+
+
+def dumps_shared(data, path: str = None) -> bytes:
+    """
+    pickle data with SharedPickler
+    """
+    file = io.BytesIO()
+    SharedPickler(file, path).dump(data)
+    return file.getvalue()
+
+
+def loads_shared(payload: bytes):
+    """
+    unpickle data pickled with SharedPickler
+    """
+    return SharedUnpickler(io.BytesIO(payload)).load()
+
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except PermissionError as e:
+        print("cannot delete {0}, {1}".format(path, e))
 
 
 def call_target(target, args: dict, tmp_path: str = None):
@@ -23,7 +339,8 @@ def call_target(target, args: dict, tmp_path: str = None):
     args: dict
         argument of the target
     tmp_path: str, default=None
-        if specified, save the target result as a temporary .pkl file
+        if specified, pickle the target result in a temporary file, numeric
+        arrays are sent through shared memory (see SharedPickler)
 
     Return
     ------
@@ -32,38 +349,261 @@ def call_target(target, args: dict, tmp_path: str = None):
     """
     try:
         res = target(**args)
+    except parallel.Cancelled as e:
+        res = e
     except Exception as e:
         res = e
         print("".join(traceback.format_tb(res.__traceback__)[1:]))
     if tmp_path is not None:
         with open(tmp_path, "wb") as f:
-            pickle.dump(res, f)
+            SharedPickler(f, tmp_path).dump(res)
     return res
 
 
+def report_progress(value: RawValue, fraction: float):
+    """
+    store the progress of a target in a value shared between processes
+    """
+    value.value = fraction
+
+
+def work(connection, progress: RawValue, cancelled: RawValue):
+    """
+    loop of a worker process: run the targets received through the connection
+    and send back True when the result is saved, see call_target
+    """
+    # heavy modules are imported once, before the first target
+    import src.model.model  # noqa: F401
+
+    def run_task(payload: bytes, report: bool, cancellable: bool):
+        # unpickled here so that errors are sent back as the result
+        target, args = loads_shared(payload)
+        if report:
+            args = dict(args, progress=functools.partial(report_progress, progress))
+        if cancellable:
+            args = dict(args, cancel=parallel.CancelToken(cancelled))
+        return target(**args)
+
+    while True:
+        try:
+            payload, tmp_path, report, cancellable = connection.recv()
+        except (EOFError, OSError):
+            return
+        args = {"payload": payload, "report": report, "cancellable": cancellable}
+        call_target(run_task, args, tmp_path)
+        connection.send(True)
+
+
+class Worker:
+    """
+    long-lived process running targets one after the other
+
+    Attributes
+    ----------
+    process: Process
+        the process to suspend, resume or terminate
+    progress: RawValue
+        progress of the running target, -1 if not reported
+    cancelled: RawValue
+        cancel flag of the running target, see parallel.CancelToken
+
+    """
+
+    def __init__(self):
+        self.connection, child_connection = Pipe()
+        self.progress = RawValue("d", -1.0)
+        self.cancelled = RawValue("b", 0)
+        self.process = Process(
+            target=work,
+            args=[child_connection, self.progress, self.cancelled],
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+
+    def run(
+        self,
+        target,
+        args: dict,
+        tmp_path: str,
+        report: bool = False,
+        cancellable: bool = False,
+    ) -> bool:
+        """
+        run a target in the worker and wait for its end, the result is saved
+        in tmp_path (see call_target). If cancellable, the target receives
+        a CancelToken on the 'cancelled' flag, which is not reset here so that
+        a cancellation requested before the run is not lost
+
+        Return
+        ------
+        result: bool
+            False if the worker was killed
+
+        """
+        # input arrays are sent by reference
+        file = io.BytesIO()
+        pickler = SharedPickler(file)
+        pickler.dump((target, args))
+        self.progress.value = -1.0
+        try:
+            self.connection.send((file.getvalue(), tmp_path, report, cancellable))
+            return self.connection.recv()
+        except (EOFError, OSError):
+            return False
+        finally:
+            # the copies of the inputs are not counted in any memory budget
+            release_copies(pickler.copies)
+
+    def close(self):
+        self.connection.close()
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class WorkerPool:
+    """
+    pool of warm worker processes, a worker killed during a run is replaced.
+    Workers are started on first use (or by 'start') and kept for the
+    following runs
+
+    Parameters
+    ----------
+    size: int, default=None
+        number of idle workers kept alive, if None use DEFAULT["worker_processes"]
+        or DEFAULT["max_parallel_modules"] or 2
+
+    """
+
+    def __init__(self, size: int = None):
+        if size is None:
+            size = DEFAULT.get("worker_processes") or DEFAULT.get(
+                "max_parallel_modules"
+            )
+        self.size = size or 2
+        self.idle = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        start the missing idle workers
+        """
+        with self._lock:
+            self.idle = [w for w in self.idle if w.process.is_alive()]
+            for _ in range(self.size - len(self.idle)):
+                self.idle.append(Worker())
+
+    def acquire(self) -> Worker:
+        """
+        get an idle worker, a new one if all workers are busy
+        """
+        with self._lock:
+            while self.idle:
+                worker = self.idle.pop()
+                if worker.process.is_alive():
+                    return worker
+                worker.close()
+        return Worker()
+
+    def release(self, worker: Worker):
+        """
+        give back a worker after a run, a dead worker is replaced
+        """
+        if not worker.process.is_alive():
+            worker.close()
+            worker = Worker()
+        with self._lock:
+            if len(self.idle) < self.size:
+                self.idle.append(worker)
+                return
+        worker.close()
+
+    def close(self):
+        with self._lock:
+            for worker in self.idle:
+                worker.close()
+            self.idle = []
+
+
+# shared by every Runner running in a process
+WORKER_POOL = WorkerPool()
+
+# time given to a cancelled target to stop before it is terminated, in ms
+CANCEL_DELAY = 2000
+
+
 class Runner(QtCore.QThread):
     """
     QThread that activate a function with arguments
 
+    If the target has a 'progress' argument, it receives a function to call
+    with its fractional progress, which is sent through 'progressed' signal.
+    If the target has a 'cancel' argument, it receives a parallel.CancelToken
+    set by 'cancel', the target then stops cleanly between two blocks. A
+    target still running CANCEL_DELAY ms later (e.g. reading a single file,
+    no block to stop between) is terminated
+
     Parameters
     ----------
     target: function or class method
     args: target arguments
-    mode: bool, default=False
-        if True, call the target inside a Process
+    in_process: bool, default=False
+        if True, call the target inside a worker process of WORKER_POOL
+    summarize: function, default=None
+        called in the thread on the result, its return value is stored in
+        'statistics'
 
     """
 
-    def __init__(self, target, args: dict, in_process: bool = False):
+    progressed = QtCore.pyqtSignal(float)
+
+    def __init__(self, target, args: dict, in_process: bool = False, summarize=None):
         super().__init__()
         self.target = target
         self.args = args
+        self.summarize = summarize
         self.tmp_path = os.path.join(TMP_DIR, str(datetime.now().timestamp()))
         self.in_process = in_process
         self.proc = None
+        self.in_target = False
+
+        # progress is polled from the main thread, -1 if not reported yet
+        self.progress = RawValue("d", -1.0)
+        self._last_progress = -1.0
+        parameters = inspect.signature(target).parameters
+        self.report = "progress" in parameters
+        self.cancellable = "cancel" in parameters
+        self.cancel_token = parallel.CancelToken()
+        if not in_process:
+            self.args = dict(args)
+            if self.report:
+                progress = functools.partial(report_progress, self.progress)
+                self.args["progress"] = progress
+            if self.cancellable:
+                self.args["cancel"] = self.cancel_token
+        self.timer = QtCore.QTimer()
+        self.timer.setInterval(100)
+        self.timer.timeout.connect(self.checkProgress)
+        self.finished.connect(self.timer.stop)
+        self.cancel_timer = QtCore.QTimer()
+        self.cancel_timer.setSingleShot(True)
+        self.cancel_timer.setInterval(CANCEL_DELAY)
+        self.cancel_timer.timeout.connect(self.terminateTarget)
+        self.finished.connect(self.cancel_timer.stop)
 
         # where the function result is stored
         self.out = None
+        self.statistics = None
+
+    def checkProgress(self):
+        value = self.progress.value
+        if value >= 0 and value != self._last_progress:
+            self._last_progress = value
+            self.progressed.emit(value)
+
+    def start(self):
+        self.timer.start()
+        QtCore.QThread.start(self)
 
     def suspend(self):
         if self.proc:
@@ -73,36 +613,78 @@ class Runner(QtCore.QThread):
         if self.proc:
             psutil.Process(self.proc.pid).resume()
 
+    def cancel(self):
+        """
+        ask the target to stop, see parallel.CancelToken, it is terminated
+        if it does not stop in time
+        """
+        self.cancel_token.cancel()
+        # a suspended process would only stop when resumed
+        self.resume()
+        if self.isRunning():
+            self.cancel_timer.start()
+
     def terminate(self):
         if self.proc:
-            psutil.Process(self.proc.pid).terminate()
+            process = psutil.Process(self.proc.pid)
+            process.terminate()
+            # a suspended process would only end when resumed
+            process.resume()
         else:
             return QtCore.QThread.terminate(self)
 
+    def terminateTarget(self):
+        """
+        terminate the target if it is still running, not the handling of its
+        result (statistics, cache) which may hold locks
+        """
+        if self.proc or self.in_target:
+            self.terminate()
+
     def run(self):
         if self.in_process:
-            self.proc = Process(
-                target=call_target, args=[self.target, self.args, self.tmp_path]
-            )
-            self.proc.start()
-            self.proc.join()
+            worker = WORKER_POOL.acquire()
+            self.progress, self.proc = worker.progress, worker.process
+            # use the flag of the worker, keeping a cancellation already asked
+            token, requested = parallel.CancelToken(worker.cancelled), self.cancel_token
+            token.reset()
+            self.cancel_token = token
+            if requested.cancelled:
+                token.cancel()
+            try:
+                worker.run(
+                    self.target,
+                    self.args,
+                    self.tmp_path,
+                    self.report,
+                    self.cancellable,
+                )
+                self.receive()
+            except Exception as e:
+                # target or arguments cannot be pickled
+                self.out = e
+            # the worker may run another target once released
+            self.proc = None
+            WORKER_POOL.release(worker)
         else:
-            call_target(self.target, self.args, self.tmp_path)
-
-        self.receive()
+            # same process, no need to go through a temporary file
+            self.in_target = True
+            self.out = call_target(self.target, self.args)
+            self.in_target = False
+        if self.summarize is not None:
+            # out of the gui thread
+            self.statistics = self.summarize(self.out)
 
     def receive(self):
         """
         load the result saved in the temporary file by the 'call_target' function
-        and delete the file.
+        and delete the file. Arrays are mapped from the shared memory instead of
+        being copied.
         """
         if os.path.isfile(self.tmp_path):
             with open(self.tmp_path, "rb") as f:
-                self.out = pickle.load(f)
-            try:
-                os.remove(self.tmp_path)
-            except PermissionError as e:
-                print("cannot delete {0}, {1}".format(self.tmp_path, e))
+                self.out = SharedUnpickler(f).load()
+            remove_file(self.tmp_path)
 
 
 def delete_runner(module):
@@ -127,7 +709,8 @@ def manager(thread_mode: ThreadMode = 0):
         1: thread enabled (terminate thread when possible)
             warning: termination may be dangerous
         2: subprocess enabled (suspend, resume and terminate process instantly)
-            warning: use 2 more seconds at each time to build the Process
+            the process is a warm worker of WORKER_POOL, arguments and result
+            are sent between processes
 
     """
 
@@ -141,12 +724,24 @@ def manager(thread_mode: ThreadMode = 0):
 
             # start the process inside a QThread
             if not presenter.threading_enabled or thread_mode == 0:
-                presenter.post_manager(module, call_target(function, args))
+                output = call_target(function, args)
+                statistics = presenter.finish_output(module, output)
+                presenter.post_manager(module, output, statistics=statistics)
             else:
-                module.runner = Runner(function, args, thread_mode == 2)
+                module.runner = Runner(
+                    function,
+                    args,
+                    thread_mode == 2,
+                    functools.partial(presenter.finish_output, module),
+                )
+                module.runner.progressed.connect(module.setProgress)
                 module.runner.finished.connect(
                     lambda: (
-                        presenter.post_manager(module, module.runner.out),
+                        presenter.post_manager(
+                            module,
+                            module.runner.out,
+                            statistics=module.runner.statistics,
+                        ),
                         delete_runner(module),
                     )
                 )
@@ -190,3 +785,31 @@ def get_checked(
                     return name
                 checked.append(name)
     return checked
+
+
+def get_fingerprint(
+    module_type: str, parameters: dict, parents: list[str], files: list[str] = None
+) -> str:
+    """
+    get a fingerprint of the result of a module, it changes when the module
+    type, its parameters, the fingerprint of a parent or a file read changes
+
+    Parameters
+    ----------
+    module_type: str
+    parameters: dict
+        parameters of the module, see QGraphicsModule.getSettings
+    parents: list of str
+        fingerprints of the results of the parents, in order
+    files: list of str, default=None
+        files read by the module, their name, modification time and size
+        are used
+
+    """
+    content = [module_type, parameters, parents]
+    for path in files or []:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            content.append([path, stat.st_mtime_ns, stat.st_size])
+    content = json.dumps(content, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode()).hexdigest()
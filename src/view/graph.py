@@ -3,10 +3,12 @@ import json
 import os
 from datetime import datetime
 
+import numpy as np
 from PyQt5 import QtCore, QtGui, QtWidgets
 
 from src import DEFAULT, RSC_DIR
 from src.view.graph_bricks import QGraphicsLink, QGraphicsModule
+from src.view.stack import ResultStack
 from src.view.utils import GraphOrientation, menu_from_dict
 
 # stack under, raise, show
@@ -51,7 +53,12 @@ class QGraph(QtWidgets.QGraphicsView):
         self.name = self.saveName
         self.saveDir = os.path.join(RSC_DIR, "data", "out")
         self.savePathIsSet = False
-        self.resultStack = {}
+        # results above the memory budget are spilled to disk
+        self.resultStack = ResultStack(on_spill=self.updateSpilledStatistics)
+        # statistics of the results, computed once per result
+        self.statisticsStack = {}
+        # fingerprint of the parameters and inputs of each result
+        self.fingerprintStack = {}
 
     def bind(self, parent, child):
         """
@@ -226,12 +233,18 @@ class QGraph(QtWidgets.QGraphicsView):
         new_name = self.getUniqueName(new_name, exception=module.name)
         self.modules[new_name] = self.modules.pop(module.name)
         if module.name in self.resultStack:
-            self.resultStack[new_name] = self.resultStack.pop(module.name)
+            self.resultStack.rename(module.name, new_name)
+        if module.name in self.statisticsStack:
+            self.statisticsStack[new_name] = self.statisticsStack.pop(module.name)
+        if module.name in self.fingerprintStack:
+            self.fingerprintStack[new_name] = self.fingerprintStack.pop(module.name)
         module.rename(new_name)
 
     def releaseData(self, module: QGraphicsModule):
         if module.name in self.resultStack:
             del self.resultStack[module.name]
+        self.statisticsStack.pop(module.name, None)
+        self.fingerprintStack.pop(module.name, None)
 
     def colorizeModule(self, module: QGraphicsModule, new_color=None):
         if new_color is None:
@@ -271,13 +284,71 @@ class QGraph(QtWidgets.QGraphicsView):
         del self.modules[parent.name]
 
     def getData(self, name: str):
+        """
+        get the result of a module, arrays are read-only views shared by every
+        module (no copy), a module modifying its input must copy it first
+        """
         if isinstance(name, list):
             return [self.getData(n) for n in name]
-        else:
-            return copy.copy(self.resultStack.get(name))
+        data = self.resultStack.get(name)
+        if isinstance(data, np.ndarray):
+            data = data.view()
+            data.flags.writeable = False
+            return data
+        return copy.copy(data)
+
+    def storeData(
+        self,
+        name: str,
+        data,
+        statistics=None,
+        fingerprint: str = None,
+        shared: bool = False,
+    ):
+        """
+        store the result of a module
 
-    def storeData(self, name: str, data):
-        self.resultStack[name] = data
+        Parameters
+        ----------
+        name: str
+        data: any type data
+        statistics: default=None
+            statistics of data (min, max, ...), replace the previous ones
+        fingerprint: str, default=None
+            fingerprint of the parameters and inputs the data was computed with
+        shared: bool, default=False
+            True if data is also held elsewhere (e.g. by the load cache),
+            it is not spilled to disk since it would free nothing
+        """
+        self.statisticsStack.pop(name, None)
+        if statistics is not None:
+            self.statisticsStack[name] = statistics
+        self.fingerprintStack.pop(name, None)
+        if fingerprint is not None:
+            self.fingerprintStack[name] = fingerprint
+        # stored last, it may spill data and update the statistics
+        self.resultStack.store(name, data, shared)
+
+    def updateSpilledStatistics(self, name: str, data, spilled):
+        """
+        statistics keep their data to compute their histogram, they must use
+        the spilled copy so that the data can be freed
+        """
+        statistics = self.statisticsStack.get(name)
+        if getattr(statistics, "data", None) is data:
+            statistics.data = spilled
+
+    def getStatistics(self, name: str):
+        """
+        get the statistics stored with a result, None if there are none
+        """
+        return self.statisticsStack.get(name)
+
+    def getFingerprint(self, name: str) -> str:
+        """
+        get the fingerprint stored with a result, None if there is none
+        """
+        return self.fingerprintStack.get(name)
 
     def addModule(
         self,
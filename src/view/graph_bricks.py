@@ -50,9 +50,9 @@ class QGraphicsModule(QtWidgets.QWidget):
         self.moveBy = self._item.moveBy
         self.pos = self._item.pos
         self.getData = self.graph.getData
-        self.propagation_child = None
         self.heights = {}
         self.runner = None
+        self.fingerprint = None
         self.setToolTip(type)
         self.initUI(name)
 
@@ -185,8 +185,24 @@ class QGraphicsModule(QtWidgets.QWidget):
         self.loading.setAutoFillBackground(True)
         self.loading.setPalette(pal)
         # if maxi to 0, the progress bar will run over and over
+        self.loading.reset()
         self.loading.setMaximum(maxi)
 
+    def setProgress(self, fraction: float):
+        """
+        show the progress of the running process in the progress bar
+
+        Parameters
+        ----------
+        fraction: float
+            between 0 and 1
+
+        """
+        if self.state != "loading":
+            return
+        self.loading.setMaximum(100)
+        self.loading.setValue(int(round(fraction * 100)))
+
     def isSelected(self) -> bool:
         return self.selected.isChecked()
 
@@ -385,7 +401,10 @@ class QGraphicsModule(QtWidgets.QWidget):
             new_widget.save.clicked.connect(self.saveDataClicked.emit)
             new_widget.release.clicked.connect(self.releaseData)
         elif isinstance(result, np.ndarray):
-            new_widget = ui.QImageRenderer(result, self)
+            statistics = None
+            if self.graph.resultStack.get(self.name) is result:
+                statistics = self.graph.getStatistics(self.name)
+            new_widget = ui.QImageRenderer(result, self, statistics)
             new_widget.mousePressEvent = self.snapMousePressEvent
             new_widget.syncSignal.connect(self.synchronizeImages)
         else:
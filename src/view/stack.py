@@ -0,0 +1,252 @@
+import itertools
+import os
+import queue
+import threading
+import weakref
+from collections.abc import MutableMapping
+
+import numpy as np
+
+from src import DEFAULT, TMP_DIR
+
+# order of the last access to a result, shared by every stack
+_clock = itertools.count()
+
+# arrays waiting to be spilled, written by a single thread shared by every stack
+_writes = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def write_spilled():
+    """
+    write the queued arrays in their file and swap them in their stack
+    """
+    while True:
+        ref, data, path = _writes.get()
+        try:
+            try:
+                np.save(path, data, allow_pickle=False)
+                spilled = np.load(path, mmap_mode="r")
+            except OSError:
+                # disk full, the array stays in memory
+                spilled = None
+            stack = ref()
+            if stack is None or not stack.swap(data, spilled, path):
+                del spilled
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        finally:
+            _writes.task_done()
+
+
+def start_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=write_spilled, daemon=True)
+            _writer.start()
+
+
+def get_budget(key: str) -> int:
+    """
+    get a memory budget from the defaults, in bytes (None if unlimited)
+    """
+    budget = DEFAULT.get(key)
+    return None if budget is None else int(budget * 2**20)
+
+
+class ResultStack(MutableMapping):
+    """
+    dictionary of module results with a memory budget
+
+    Arrays held in memory are counted in the budget of the stack and in the
+    budget of the whole application. Above a budget, the least recently used
+    arrays are saved in TMP_DIR and replaced by read-only memory-mapped
+    arrays, the system pages them in when they are read. Files are written
+    by a background thread so that storing a result never waits for the
+    disk, see flush. Arrays also held
+    elsewhere (e.g. by the load cache) are neither counted nor spilled, it
+    would free nothing.
+
+    Parameters
+    ----------
+    max_bytes: int, default=None
+        budget of the stack, if None use DEFAULT["graph_memory_budget"] (MB)
+    on_spill: function, default=None
+        called as on_spill(name, old, new) when an array is replaced by its
+        memory-mapped copy
+
+    """
+
+    # stacks sharing DEFAULT["memory_budget"]
+    _stacks = weakref.WeakValueDictionary()
+    _lock = threading.RLock()
+
+    def __init__(self, max_bytes: int = None, on_spill=None):
+        if max_bytes is None:
+            max_bytes = get_budget("graph_memory_budget")
+        self.max_bytes = max_bytes
+        self.on_spill = on_spill
+        self.nbytes = 0
+        self._items = {}
+        # {name: last access} of the arrays held in memory
+        self._accesses = {}
+        # {name: path} of the spilled arrays
+        self._paths = {}
+        ResultStack._stacks[id(self)] = self
+
+    @staticmethod
+    def isSpillable(data) -> bool:
+        return (
+            isinstance(data, np.ndarray)
+            and not isinstance(data, np.memmap)
+            and not data.dtype.hasobject
+            and data.nbytes > 0
+        )
+
+    def __getitem__(self, name: str):
+        with self._lock:
+            data = self._items[name]
+            if name in self._accesses:
+                self._accesses[name] = next(_clock)
+            return data
+
+    def __setitem__(self, name: str, data):
+        self.store(name, data)
+
+    def store(self, name: str, data, shared: bool = False):
+        """
+        store a result
+
+        Parameters
+        ----------
+        name: str
+        data: any type data
+        shared: bool, default=False
+            True if data is also held elsewhere, it is not spilled
+
+        """
+        with self._lock:
+            if name in self._items:
+                del self[name]
+            self._items[name] = data
+            if not shared and self.isSpillable(data):
+                self._accesses[name] = next(_clock)
+                self.nbytes += data.nbytes
+                self.spill()
+
+    def __delitem__(self, name: str):
+        with self._lock:
+            data = self._items.pop(name)
+            if self._accesses.pop(name, None) is not None:
+                self.nbytes -= data.nbytes
+            self.removeFile(name)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __del__(self):
+        for name in list(self._paths):
+            self.removeFile(name)
+
+    def removeFile(self, name: str):
+        path = self._paths.pop(name, None)
+        if path is not None:
+            try:
+                os.remove(path)
+            except OSError:
+                # still mapped (windows) or already removed with TMP_DIR
+                pass
+
+    def rename(self, name: str, new_name: str):
+        """
+        move a result to a new name, without counting it as an access
+        """
+        with self._lock:
+            self._items[new_name] = self._items.pop(name)
+            if name in self._accesses:
+                self._accesses[new_name] = self._accesses.pop(name)
+            if name in self._paths:
+                self._paths[new_name] = self._paths.pop(name)
+
+    def spill(self):
+        """
+        spill the least recently used arrays until the stack and the whole
+        application fit in their budget
+        """
+        with self._lock:
+            while self.max_bytes is not None and self.nbytes > self.max_bytes:
+                self.spillItem(min(self._accesses, key=self._accesses.get))
+            max_bytes = get_budget("memory_budget")
+            if max_bytes is None:
+                return
+            stacks = list(ResultStack._stacks.values())
+            while sum(s.nbytes for s in stacks) > max_bytes:
+                stack, name = min(
+                    ((s, n) for s in stacks for n in s._accesses),
+                    key=lambda item: item[0]._accesses[item[1]],
+                )
+                stack.spillItem(name)
+
+    def spillItem(self, name: str):
+        """
+        remove an array from the budget and queue its copy in TMP_DIR,
+        it is replaced by the memory-mapped copy once written (see swap)
+        """
+        data = self._items[name]
+        del self._accesses[name]
+        self.nbytes -= data.nbytes
+        os.makedirs(TMP_DIR, exist_ok=True)
+        filename = "stack_{}_{}.npy".format(id(self), next(_clock))
+        start_writer()
+        _writes.put((weakref.ref(self), data, os.path.join(TMP_DIR, filename)))
+
+    def swap(self, data, spilled, path: str) -> bool:
+        """
+        replace a spilled array by its memory-mapped copy, called by the
+        writer thread once the file is complete
+
+        Parameters
+        ----------
+        data: np.ndarray
+            array in memory
+        spilled: np.memmap
+            copy of data, None if it could not be written
+        path: str
+            file of the copy
+
+        Return
+        ------
+        result: bool
+            False if data was deleted or stored again meanwhile, the file
+            is not used
+
+        """
+        with self._lock:
+            name = next((n for n, d in self._items.items() if d is data), None)
+            if name is None or name in self._accesses:
+                return False
+            if spilled is None:
+                # counted again, it may be spilled later
+                self._accesses[name] = next(_clock)
+                self.nbytes += data.nbytes
+                return False
+            self._items[name] = spilled
+            self._paths[name] = path
+            if self.on_spill is not None:
+                self.on_spill(name, data, spilled)
+            return True
+
+    @staticmethod
+    def flush():
+        """
+        wait until every queued array is written and swapped, must not be
+        called while holding the lock of a stack
+        """
+        _writes.join()
@@ -1,4 +1,3 @@
-import copy
 import os
 import traceback
 
@@ -213,9 +212,11 @@ class QCustomTableWidget(QtWidgets.QWidget):
 class QImageRenderer(QtWidgets.QLabel):
     syncSignal = QtCore.pyqtSignal()
 
-    def __init__(self, img: np.ndarray, parent):
+    def __init__(self, img: np.ndarray, parent, statistics=None):
         QtWidgets.QWidget.__init__(self)
-        self.img = self.formatImage(img)
+        # only the displayed slice is scaled, memory-mapped images stay on disk
+        self.img = img
+        self.range = self.getRange(img, statistics)
 
         self.getImageType()
 
@@ -223,23 +224,47 @@ class QImageRenderer(QtWidgets.QLabel):
         self._parent = parent
         self.updateSnap()
 
+    def getRange(self, img: np.ndarray, statistics=None) -> tuple[float, float]:
+        """
+        get the range of finite values, displayed in (1, 255). None if the
+        statistics are not computed yet, each slice is then scaled with its
+        own range so that the data is not read for display
+        """
+        if statistics is not None and not statistics.computed:
+            return None
+        if statistics is not None:
+            # min and max of finite values already computed for the result
+            if statistics.count == 0:
+                return 0, 1
+            mini, maxi = statistics.min, statistics.max
+        elif img.dtype.kind != "f":
+            mini, maxi = np.min(img), np.max(img)
+        else:
+            finite = np.isfinite(img)
+            if not finite.any():
+                return 0, 1
+            mini = np.min(img, where=finite, initial=np.inf)
+            maxi = np.max(img, where=finite, initial=-np.inf)
+        if mini == maxi:
+            return 0, max(maxi, 1)
+        return mini, maxi
+
     def formatImage(self, img: np.ndarray) -> np.ndarray:
-        img = img.astype(np.float64) if img.dtype != np.float64 else copy.copy(img)
-        img[np.isinf(img)] = np.nan
+        # nan and inf values are ignored and displayed as 0
+        finite = np.isfinite(img) if img.dtype.kind == "f" else None
+        mini, maxi = self.range or self.getRange(img)
 
-        # scale image in range (1, 255)
-        mini, maxi = np.nanmin(img), np.nanmax(img)
-        if mini == maxi:
-            mini = 0
-            maxi = max(maxi, 1)
-        img = (img - mini) / (maxi - mini) * 254 + 1
+        # scale image in range (1, 255), float32 is precise enough for display
+        scaled = np.subtract(img, mini, dtype=np.float32)
+        scaled *= 254 / (float(maxi) - float(mini))
+        scaled += 1
 
         # set 0 as nan values
-        img[np.isnan(img)] = 0
+        if finite is not None:
+            scaled[~finite] = 0
 
         # convert and store
-        img = img.astype(np.uint8)
-        return img
+        return scaled.astype(np.uint8)
 
     def wheelEvent(self, event):
         if not self.slicable:
@@ -283,11 +308,12 @@ class QImageRenderer(QtWidgets.QLabel):
 
     def getSliceParams(self) -> tuple[np.ndarray, int, int, int]:
         if self.img.ndim == 2:
-            return self.img, self.img.shape[1], self.img.shape[0], self.img.shape[1]
+            im = self.formatImage(self.img)
+            return im, self.img.shape[1], self.img.shape[0], self.img.shape[1]
         elif self.img.ndim == 3:
             if not self.slicable:
                 return (
-                    self.img,
+                    self.formatImage(self.img),
                     self.img.shape[1],
                     self.img.shape[0],
                     self.img.shape[1] * self.img.shape[2],
@@ -305,16 +331,17 @@ class QImageRenderer(QtWidgets.QLabel):
 
                 # snap axis slice
                 if self.axis == 0:
-                    im_slice = self.img[self.currentSlice].copy()
+                    im_slice = self.img[self.currentSlice]
                     _, h, w = self.img.shape
                 elif self.axis == 1:
-                    im_slice = self.img[:, self.currentSlice].copy()
+                    im_slice = self.img[:, self.currentSlice]
                     h, _, w = self.img.shape
                 elif self.axis == 2:
-                    im_slice = self.img[:, :, self.currentSlice].copy()
+                    im_slice = self.img[:, :, self.currentSlice]
                     h, w, _ = self.img.shape
 
-                return im_slice, w, h, w
+                # scaled into a new contiguous array
+                return self.formatImage(im_slice), w, h, w
 
     def updateSnap(self):
         im, w, h, bytesPerLine = self.getSliceParams()
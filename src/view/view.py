@@ -19,6 +19,8 @@ class View(QtWidgets.QMainWindow):
 
     closed = QtCore.pyqtSignal()
     moduleAdded = QtCore.pyqtSignal(QGraphicsModule)
+    runRequested = QtCore.pyqtSignal(QGraph)
+    fileOpened = QtCore.pyqtSignal(QGraph)
 
     def __init__(self, nopopup: bool = False):
         super().__init__()
@@ -34,6 +36,8 @@ class View(QtWidgets.QMainWindow):
         self.actionSaveAs.triggered.connect(self.saveAsFile)
         self.initNewFile.clicked.connect(self.newFile)
 
+        self.actionRunGraph.triggered.connect(self.runGraph)
+
         self.modules = json.load(open(os.path.join(CONFIG_DIR, "modules.json"), "rb"))
         self.initStyle()
         self.initUI()
@@ -228,6 +232,7 @@ class View(QtWidgets.QMainWindow):
         if os.path.isfile(filename):
             gf = self.newFile()
             gf.restore(filename)
+            self.fileOpened.emit(gf)
 
     def saveFile(self):
         self.tabWidget.currentWidget().saveFile()
@@ -235,6 +240,10 @@ class View(QtWidgets.QMainWindow):
     def saveAsFile(self):
         self.tabWidget.currentWidget().saveAsFile()
 
+    def runGraph(self):
+        if self.graph() is not None:
+            self.runRequested.emit(self.graph())
+
     def askSaveFiles(self) -> QMessageBox.StandardButton:
         for gf in self.graphs.values():
             if (
@@ -1,6 +1,8 @@
 # Test of basic application usage
 
+import io
 import os
+import time
 
 import numpy as np
 import pytest
@@ -83,6 +85,323 @@ def test_show_text(qtbot, francis, load_module, text_filepath):
     assert load_module.result.toPlainText()
 
 
+def test_run_graph(qtbot, francis, text_filepath):
+    qtbot.addWidget(francis)
+    modules = [francis.graph().addModule("Load") for _ in range(2)]
+    for module in modules:
+        qtbot.keyClicks(module.parameters.path, text_filepath)
+    with qtbot.waitSignals([m.displayed for m in modules], timeout=10000):
+        francis.runGraph()
+
+    for module in modules:
+        assert module.result.toPlainText()
+
+
+def test_run_graph_stale(qtbot, francis, tmp_path):
+    qtbot.addWidget(francis)
+    path = tmp_path / "text.txt"
+    path.write_text("first")
+    load_module = francis.graph().addModule("Load")
+    qtbot.keyClicks(load_module.parameters.path, str(path))
+    with qtbot.waitSignal(load_module.displayed, timeout=10000):
+        francis.runGraph()
+    result = francis.graph().resultStack[load_module.name]
+
+    # up to date results are reused
+    francis.runGraph()
+    assert load_module.state == "valid"
+    assert francis.graph().resultStack[load_module.name] is result
+
+    # a modified input makes the result stale
+    path.write_text("second version")
+    with qtbot.waitSignal(load_module.displayed, timeout=10000):
+        francis.runGraph()
+    assert "second" in load_module.result.toPlainText()
+
+
+def test_fingerprint(qtbot, tmp_path):
+    view = View(nopopup=True)
+    presenter = Presenter(view, Model(), threading_enabled=False)
+    view.newFile()
+    qtbot.addWidget(view)
+    graph = view.graph()
+    load_module = graph.addModule("Load")
+    info_module = graph.addModule("GetInfo", load_module)
+    for i in range(2):
+        Model().save(np.full((4, 4), 10, np.uint8), str(tmp_path / "s{}.png".format(i)))
+
+    # every slice of a directory or a glob pattern is part of the fingerprint
+    for size, path in [(8, str(tmp_path)), (16, str(tmp_path / "s*.png"))]:
+        load_module.parameters.path.setText(path)
+        fingerprint = presenter.get_fingerprint(load_module)
+        Model().save(np.full((size, size), 10, np.uint8), str(tmp_path / "s1.png"))
+        assert presenter.get_fingerprint(load_module) != fingerprint
+
+    # the inputs are the results stored for the parents
+    graph.storeData(load_module.name, np.zeros(3), fingerprint="first")
+    fingerprint = presenter.get_fingerprint(info_module)
+    graph.storeData(load_module.name, np.zeros(3), fingerprint="second")
+    assert presenter.get_fingerprint(info_module) != fingerprint
+
+
+def test_scheduler_stopped_parent():
+    from types import SimpleNamespace
+
+    from src.presenter.scheduler import Scheduler
+
+    class Module:
+        def __init__(self, name, parents=[]):
+            self.name, self.graph, self.parents, self.childs = name, graph, parents, []
+            self.state = None
+            graph.modules[name] = self
+            for parent in parents:
+                parent.childs.append(self)
+
+        def setState(self, state=None):
+            self.state = state
+
+    graph = SimpleNamespace(resultStack={"parent": "previous result"}, modules={})
+    parent = Module("parent")
+    child = Module("child", [parent])
+    started = []
+    scheduler = Scheduler(started.append)
+    scheduler.request(parent)
+    scheduler.request(child)
+    assert started == [parent] and child.state == "loading"
+    # stopped without a new result: the child does not use the previous one
+    scheduler.done(parent, updated=False)
+    assert started == [parent] and child.state is None and not scheduler.pending
+
+
+def test_scheduler_stale_memo():
+    from types import SimpleNamespace
+
+    from src.presenter.scheduler import Scheduler
+
+    class Module:
+        def __init__(self, name, parents):
+            self.name, self.graph, self.parents = name, graph, parents
+            graph.resultStack[name] = "result"
+
+    graph = SimpleNamespace(resultStack={}, getFingerprint=lambda name: name)
+    # chain of diamonds, each module has the two modules of the level above
+    level = [Module("root", [])]
+    for i in range(20):
+        level = [Module(f"{i}{j}", level) for j in "ab"]
+    computed = []
+
+    def fingerprint(module):
+        computed.append(module)
+        return module.name
+
+    scheduler = Scheduler(None, fingerprint)
+    memo = {}
+    assert not any(scheduler.isStale(module, memo) for module in level)
+    assert len(computed) == len(set(computed)) == 41
+
+
+def test_result_cache(qtbot, tmp_path, text_filepath):
+    from src.model.cache import ResultCache
+
+    view = View(nopopup=True)
+    qtbot.addWidget(view)
+    presenter = Presenter(view, Model(), threading_enabled=False)
+    presenter.result_cache = ResultCache(str(tmp_path / "cache"), 2**20)
+    load_module = view.newFile().addModule("Load")
+    qtbot.keyClicks(load_module.parameters.path, text_filepath)
+    with qtbot.waitSignal(load_module.displayed, timeout=10000):
+        view.runGraph()
+    filename = str(tmp_path / "graph.iag")
+    view.graph().saveFile(filename)
+
+    # the results of a reopened graph are restored from the cache
+    view.openFile(filename)
+    restored = view.graph().modules[load_module.name]
+    assert restored is not load_module and restored.state == "valid"
+    assert restored.result.toPlainText() == load_module.result.toPlainText()
+
+
+def test_result_stack():
+    from src import TMP_DIR
+    from src.view.stack import ResultStack
+
+    arrays = [np.full((100, 100), i, dtype=np.float64) for i in range(3)]
+    spilled = []
+    stack = ResultStack(2 * arrays[0].nbytes, lambda *args: spilled.append(args[0]))
+    stack["a"], stack["b"], stack["text"] = arrays[0], arrays[1], "text"
+    assert stack["a"] is arrays[0] and stack.nbytes == 2 * arrays[0].nbytes
+
+    # the least recently used array is spilled to a read-only memory-mapped file
+    stack["c"] = arrays[2]
+    assert stack.nbytes == 2 * arrays[0].nbytes
+    # written by the writer thread
+    stack.flush()
+    assert spilled == ["b"] and isinstance(stack["b"], np.memmap)
+    assert np.array_equal(stack["b"], arrays[1]) and not stack["b"].flags.writeable
+    assert stack["a"] is arrays[0] and stack["text"] == "text"
+    path = stack._paths["b"]
+    del stack["b"]
+    assert not os.path.exists(path) and len(stack) == 3
+
+    # arrays held elsewhere are not counted nor spilled
+    stack.store("shared", np.zeros((100, 100)), shared=True)
+    assert stack.nbytes == 2 * arrays[0].nbytes and spilled == ["b"]
+
+    # an array deleted while being written leaves no file
+    stack["d"] = np.ones((100, 100))
+    del stack["c"]
+    stack.flush()
+    prefix = "stack_{}_".format(id(stack))
+    assert not [f for f in os.listdir(TMP_DIR) if f.startswith(prefix)]
+
+
+def test_get_data(qtbot, francis):
+    qtbot.addWidget(francis)
+    data = np.zeros((10, 10))
+    francis.graph().storeData("data", data)
+    views = francis.graph().getData(["data", "data"])
+    assert all(np.shares_memory(v, data) and not v.flags.writeable for v in views)
+    assert data.flags.writeable
+
+
+def test_renderer_slice(qtbot, tmp_path):
+    from PyQt5 import QtWidgets
+
+    from src.model.stats import Statistics
+    from src.view.ui import QImageRenderer
+
+    path = str(tmp_path / "volume.npy")
+    np.save(path, np.arange(4 * 6 * 8).reshape(4, 6, 8))
+    volume = np.load(path, mmap_mode="r")
+    parent = QtWidgets.QWidget()
+    qtbot.addWidget(parent)
+    renderer = QImageRenderer(volume, parent)
+    # the image is not copied, the slice is scaled with the range of the volume
+    assert renderer.img is volume and renderer.range == (0, 4 * 6 * 8 - 1)
+    im, w, h, _ = renderer.getSliceParams()
+    assert (w, h) == (8, 6) and im.dtype == np.uint8
+    assert 1 < im.min() and im.max() < 255
+
+    # statistics not computed yet: each slice is scaled with its own range
+    renderer = QImageRenderer(volume, parent, Statistics(volume, lazy=True))
+    assert renderer.range is None
+    im, *_ = renderer.getSliceParams()
+    assert (im.min(), im.max()) == (1, 255)
+
+
+@pytest.mark.parametrize("shared_memory", [True, False])
+def test_share_result(tmp_path, monkeypatch, shared_memory):
+    from src.presenter import utils
+
+    fits = utils.SharedArray.fitsInSharedMemory
+    monkeypatch.setattr(
+        utils.SharedArray,
+        "fitsInSharedMemory",
+        staticmethod(lambda size: shared_memory and fits(size)),
+    )
+    image = np.arange(10**5.0).reshape(100, -1)
+    result = {"image": image, "infos": (np.ones(10**4), "a")}
+    path = str(tmp_path / "result")
+    utils.call_target(lambda: result, {}, path)
+    # only the description of the arrays is pickled
+    assert os.path.getsize(path) < 1000
+
+    with open(path, "rb") as f:
+        received = utils.SharedUnpickler(f).load()
+    assert np.array_equal(received["image"], result["image"])
+    assert np.array_equal(received["infos"][0], result["infos"][0])
+    assert received["infos"][1] == "a"
+    # a received array can be sent to another process
+    sent = utils.loads_shared(utils.dumps_shared(received["image"][10:]))
+    assert np.array_equal(sent, result["image"][10:])
+    del received, sent
+    assert os.listdir(tmp_path) == ["result"]
+
+
+def test_share_inputs(tmp_path):
+    from src.presenter import utils
+
+    # inputs in shared memory or in memory-mapped files are sent by reference
+    np.save(tmp_path / "image.npy", np.arange(10**5).reshape(100, -1))
+    inputs = {
+        "loaded": np.arange(10**5.0).reshape(100, -1).T,
+        "mapped": np.load(tmp_path / "image.npy", mmap_mode="r")[::-2, 10:],
+    }
+    first, second = [utils.dumps_shared(inputs) for _ in range(2)]
+    assert len(first) < 1000 and first == second
+    received = utils.loads_shared(first)
+    for name, data in inputs.items():
+        assert np.array_equal(received[name], data)
+    shared = utils.loads_shared(utils.dumps_shared(received["loaded"][::3, 5:]))
+    assert np.array_equal(shared, inputs["loaded"][::3, 5:])
+
+    # copies used by a run are freed after it
+    image = np.ones((100, 1000))
+    pickler = utils.SharedPickler(io.BytesIO())
+    pickler.dump(image)
+    assert id(image) in utils._copies and pickler.copies == [id(image)]
+    utils.release_copies(pickler.copies)
+    assert id(image) not in utils._copies
+
+    # a copy is unlinked once its source array and the runs using it are gone
+    image = np.ones((100, 1000))
+    pickler = utils.SharedPickler(io.BytesIO())
+    pickler.dump(image[10:])
+    name = utils.SharedArray.reference(image).name
+    utils.map_shared_memory(name, track=False)[1].close()
+    del image
+    utils.release_copies(pickler.copies)
+    with pytest.raises(FileNotFoundError):
+        utils.map_shared_memory(name, track=False)
+
+
+def test_worker_pool(tmp_path):
+    from src.model import parallel
+    from src.presenter import utils
+
+    pool = utils.WorkerPool(1)
+    pool.start()
+    worker = pool.acquire()
+    path = str(tmp_path / "result")
+    assert worker.run(Model().apply_operation, {"arr": np.ones(3), "elements": 2}, path)
+    with open(path, "rb") as f:
+        assert np.array_equal(utils.SharedUnpickler(f).load(), [3, 3, 3])
+    pool.release(worker)
+    assert pool.acquire() is worker
+
+    # the target receives a token on the cancel flag of the worker
+    worker.cancelled.value = 1
+    args = {"arr": np.ones(3), "elements": 2}
+    assert worker.run(Model().apply_operation, args, path, cancellable=True)
+    with open(path, "rb") as f:
+        assert isinstance(utils.SharedUnpickler(f).load(), parallel.Cancelled)
+    worker.cancelled.value = 0
+
+    # a killed worker is replaced
+    worker.process.kill()
+    worker.process.join()
+    pool.release(worker)
+    assert pool.idle[0] is not worker and pool.idle[0].process.is_alive()
+    pool.close()
+
+
+def ignore_cancel(seconds: float, cancel=None):
+    time.sleep(seconds)
+
+
+def test_runner_terminate(qtbot, monkeypatch):
+    from src.presenter import utils
+
+    # a target not checking its token is terminated once the delay is over
+    monkeypatch.setattr(utils, "CANCEL_DELAY", 100)
+    runner = utils.Runner(ignore_cancel, {"seconds": 60}, in_process=True)
+    with qtbot.waitSignal(runner.finished, timeout=10000):
+        runner.start()
+        qtbot.waitUntil(lambda: runner.proc is not None)
+        runner.cancel()
+    assert runner.out is None
+
+
 def test_show_image(qtbot, francis, load_module, image_test):
     """Select load image node and load the demonstration image"""
     load_module.showResult(image_test)
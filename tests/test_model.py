@@ -3,6 +3,7 @@ import os
 import numpy as np
 import pytest
 
+from src.model.cache import LOAD_CACHE
 from src.model.model import Model
 
 mdl = Model()
@@ -72,6 +73,140 @@ def test_save_file(test_file_path, test_file_write_path):
         assert os.path.exists(test_file_write_path)
 
 
+def test_lazy_load(tmp_path, cube):
+    path = str(tmp_path / "lazy_image.nii")
+    mdl.save(cube.astype(np.uint8), path)
+    data = mdl.load(path, lazy=True)
+    assert isinstance(data, np.memmap)
+    assert not data.flags.writeable
+    assert np.array_equal(data, cube)
+    assert np.sum(mdl.apply_threshold(data, 0)) == 6**3
+
+
+def test_native_dtype():
+    path = os.path.join(os.getcwd(), "resources/data/cvs_avg35_inMNI152.nii.gz")
+    data = mdl.load(path)
+    assert data.dtype == np.uint8
+    assert mdl.apply_operation(data, [data, data], "add").dtype == np.uint16
+    assert mdl.apply_operation(data, 2.0, "subtract").dtype == np.int16
+    assert mdl.apply_operation(data, 2, "divide").dtype == np.float32
+    assert mdl.apply_operation(data, [data] * 20, "multiply").dtype == np.float64
+
+
+def test_save_slices(tmp_path, cube):
+    path = str(tmp_path / "slices.png")
+    fractions = []
+    mdl.save(cube, path, workers=4, progress=fractions.append)
+    root, ext = os.path.splitext(path)
+    for i in range(cube.shape[0]):
+        assert os.path.exists(os.path.join(root, "slices{}.png".format(i)))
+    assert len(fractions) == cube.shape[0]
+    assert fractions[-1] == 1
+
+
+def test_save_slices_dtype(tmp_path):
+    volume = np.full((6, 8, 8), 5, dtype=np.uint16)
+    volume[1] = 1000
+    mdl.save(volume, str(tmp_path / "volume.png"))
+    # every slice is saved with the dtype of the volume
+    loaded = mdl.load(str(tmp_path / "volume"), use_cache=False)
+    assert loaded.dtype == np.uint16 and np.array_equal(loaded, volume)
+
+
+def test_load_cache(tmp_path, square):
+    path = str(tmp_path / "cached_image.png")
+    mdl.save(square.astype(np.uint8), path)
+    data = mdl.load(path)
+    assert mdl.load(path) is data
+    assert not data.flags.writeable
+    assert mdl.load(path, use_cache=False) is not data
+    assert LOAD_CACHE.holds(data) and not LOAD_CACHE.holds(data.copy())
+
+    # a modified file is loaded again
+    mdl.save(square.astype(np.uint8) * 2, path)
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    assert np.max(mdl.load(path)) == 2
+
+
+def test_result_cache(tmp_path, square):
+    from src.model.cache import ResultCache
+
+    cache = ResultCache(str(tmp_path), max_bytes=2 * square.nbytes + 1000)
+    assert cache.get("a") is None
+    cache.put("a", square)
+    cache.put("b", "text")
+    cache.put("c", ValueError())
+    data = cache.get("a")
+    assert isinstance(data, np.memmap) and not data.flags.writeable
+    assert np.array_equal(data, square)
+    assert cache.get("b") == "text" and cache.get("c") is None
+
+    # least recently used entries are removed above the budget
+    os.utime(tmp_path / "b.pkl", ns=(0, 0))
+    cache.put("d", square + 1)
+    cache.put("e", square + 2)
+    assert cache.get("b") is None and cache.get("a") is None
+    assert np.array_equal(cache.get("e"), square + 2)
+
+
+def test_read_only_inputs(tmp_path, cube, grey_scale):
+    # results are shared between modules as read-only arrays
+    for im in [cube, grey_scale]:
+        im.flags.writeable = False
+    rgb = np.stack([grey_scale] * 3, axis=-1)
+    rgb.flags.writeable = False
+    assert np.array_equal(mdl.extract_channel(rgb, "green"), grey_scale)
+    assert mdl.get_img_infos(cube, "max") == 1
+    for operation in ["erosion", "binary_dilation", "opening", "closing"]:
+        for size in [0, 1, 10]:
+            mdl.apply_basic_morpho(cube, size, operation, workers=2)
+    mdl.apply_operation(cube, [cube, 2], "subtract")
+    mdl.apply_formula("[a] x 2 - [a]", {"a": cube})
+    mdl.apply_threshold(grey_scale, 50, method="percentile")
+    mdl.save(grey_scale, str(tmp_path / "saved_image.png"))
+
+
+def test_numpy_format(tmp_path, cube, square):
+    path = str(tmp_path / "saved_array.npy")
+    mdl.save(cube, path)
+    data = mdl.load(path, use_cache=False)
+    assert isinstance(data, np.memmap)
+    assert np.array_equal(data, cube)
+
+    path = str(tmp_path / "saved_arrays.npz")
+    mdl.save({"cube": cube, "square": square}, path)
+    data = mdl.load(path, use_cache=False)
+    assert np.array_equal(data["cube"], cube)
+    assert np.array_equal(data["square"], square)
+    mdl.save(square, path)
+    assert np.array_equal(mdl.load(path, use_cache=False), square)
+
+
+def test_load_slices(tmp_path):
+    # more than 10 slices to check natural ordering
+    cube = np.arange(12)[:, None, None] * np.ones((12, 6, 5))
+    path = str(tmp_path / "stack.png")
+    mdl.save(cube, path)
+    root, ext = os.path.splitext(path)
+    fractions = []
+    volume = mdl.load(root, use_cache=False, workers=3, progress=fractions.append)
+    assert volume.dtype == np.uint8
+    assert np.array_equal(volume, cube)
+    assert fractions[-1] == 1
+    volume = mdl.load(os.path.join(root, "stack*.png"), use_cache=False)
+    assert np.array_equal(volume, cube)
+
+
+def test_load_slices_dtype(tmp_path):
+    import imageio
+
+    imageio.imwrite(str(tmp_path / "slice0.png"), np.full((4, 4), 5, np.uint8))
+    imageio.imwrite(str(tmp_path / "slice1.png"), np.full((4, 4), 1000, np.uint16))
+    # slices are not cast into the dtype of the first one
+    with pytest.raises(ValueError, match="dtype"):
+        mdl.load(str(tmp_path), use_cache=False)
+
+
 def test_get_img_infos(square):
     assert mdl.get_img_infos(square, info="max") == 1
 
@@ -156,6 +291,106 @@ def test_dilation(cube, square):
     )
 
 
+def test_morpho_fast_paths():
+    from scipy import ndimage
+
+    from src.model import morpho
+
+    im = np.random.default_rng(0).integers(0, 255, (20, 20, 20), dtype=np.uint8)
+    dense = ndimage.grey_erosion(im, footprint=np.ones((7, 7, 7)))
+    assert np.array_equal(mdl.apply_basic_morpho(im, 3, round_shape=False), dense)
+    assert morpho.get_footprint(3, 2) is morpho.get_footprint(3, 2)
+
+    # closing and opening are different operations
+    closing = mdl.apply_basic_morpho(im, 1, "closing")
+    opening = mdl.apply_basic_morpho(im, 1, "opening")
+    assert np.all(closing >= im) and np.all(opening <= im)
+
+    # decomposed ball approximates the exact element
+    point = np.zeros((41, 41, 41), dtype=bool)
+    point[20, 20, 20] = True
+    radius = morpho.DECOMPOSITION_RADIUS + 2
+    ball = mdl.apply_basic_morpho(point, radius, "binary_dilation")
+    assert ball.dtype == bool
+    assert abs(np.sum(ball) / np.sum(morpho.get_footprint(3, radius)) - 1) < 0.1
+
+
+def test_morpho_distance_engine():
+    from scipy import ndimage
+
+    from src.model import morpho
+
+    rng = np.random.default_rng(0)
+    for shape in [(40, 50), (20, 25, 30)]:
+        mask = ndimage.uniform_filter(rng.random(shape), 5) > 0.5
+        for radius in [1, 3, 6]:
+            for operation in ["erosion", "dilation"]:
+                assert np.array_equal(
+                    morpho.apply_distance(mask, radius, operation),
+                    morpho.apply_dense(mask, radius, operation),
+                )
+
+
+def test_morpho_tiled():
+    from scipy import ndimage
+
+    rng = np.random.default_rng(0)
+    grey = (rng.random((30, 20, 20)) * 255).astype(np.uint8)
+    mask = ndimage.uniform_filter(rng.random((30, 20, 20)), 5) > 0.5
+    for im, prefix in [(grey, ""), (mask, "binary_")]:
+        for size in [1, 8]:
+            for operation in ["erosion", "opening", "closing"]:
+                for round_shape in [True, False]:
+                    args = (im, size, prefix + operation, round_shape)
+                    assert np.array_equal(
+                        mdl.apply_basic_morpho(*args, workers=1),
+                        mdl.apply_basic_morpho(*args, workers=7),
+                    )
+
+
+def test_statistics():
+    from src.model.stats import Statistics
+
+    rng = np.random.default_rng(0)
+    for data in [
+        rng.normal(100, 30, (20, 30, 40)).clip(0, 255).astype(np.uint8),
+        rng.normal(0, 1000, (30, 40)).astype(np.int16),
+    ]:
+        stats = Statistics(data, workers=3)
+        assert (stats.min, stats.max) == (data.min(), data.max())
+        assert np.isclose(stats.mean, data.mean()) and np.isclose(stats.std, data.std())
+        for q in [0, 10, 50, 99, 100]:
+            expected = np.percentile(data, q, method="inverted_cdf")
+            assert stats.percentile(q) == expected
+    data = rng.normal(0, 1, (20, 30, 40)).astype(np.float32)
+    data[0, 0, :2] = np.nan, np.inf
+    stats = Statistics(data)
+    finite = data[np.isfinite(data)]
+    assert (stats.min, stats.max) == (finite.min(), finite.max())
+    assert stats.count == finite.size
+    assert abs(stats.get("median") - np.median(finite)) < 1e-2
+    # lazy statistics read the data on first use
+    stats = Statistics(data, lazy=True)
+    assert not stats.computed
+    assert stats.get("median") == Statistics(data).get("median") and stats.computed
+    # large offset with a small spread, even count median
+    data = 1e6 + rng.normal(0, 1e-3, (8, 100, 100))
+    assert np.isclose(Statistics(data, workers=3).std, data.std(), rtol=1e-6)
+    assert Statistics(np.array([1, 2, 3, 4], np.uint8)).get("median") == 2.5
+
+
+def test_threshold_methods(grey_scale):
+    assert np.sum(mdl.apply_threshold(grey_scale, 30, method="percentile")) == 7 * 10
+    bimodal = np.concatenate([np.full(50, 10), np.full(50, 200)]).astype(np.uint8)
+    mask = mdl.apply_threshold(bimodal, 0, method="otsu")
+    assert np.array_equal(mask, bimodal > 100)
+    assert mdl.get_img_infos(grey_scale, "median") == 4.5
+    # statistics computed once are reused without the image
+    statistics = mdl.get_statistics(grey_scale)
+    assert mdl.get_img_infos(None, "max", statistics=statistics) == 9
+    assert mdl.get_statistics("text") is None
+
+
 def test_threshold(grey_scale):
     assert np.sum(mdl.apply_threshold(grey_scale, 2) > 0) == 7 * 10
     assert np.sum(mdl.apply_threshold(grey_scale, 2) > 0) == 7 * 10
@@ -179,6 +414,10 @@ def test_add_value(cube, square):
     assert np.max(mdl.apply_operation(square, 0, operation="add")) == np.max(square)
     assert np.max(mdl.apply_operation(cube, 2, operation="add")) == np.max(cube) + 2
     assert np.max(mdl.apply_operation(cube, 0, operation="add")) == np.max(cube)
+    # operations between values give a numpy scalar
+    result = mdl.apply_operation(3.0, 2, operation="add")
+    assert np.ndim(result) == 0 and not isinstance(result, np.ndarray)
+    assert result == 5
 
 
 def test_add_image(cube, square):
@@ -233,6 +472,101 @@ def test_multiply_image(cube, square):
     assert np.array_equal(self_multiply, square)
 
 
+def test_operation_many_elements():
+    rng = np.random.default_rng(0)
+    arr = rng.random((64, 128, 128), dtype=np.float32)
+    elements = [rng.random((64, 128, 128), dtype=np.float32) for _ in range(5)]
+    for operation, function in [("add", np.add), ("subtract", np.subtract)]:
+        expected = arr
+        for element in elements + [2.0]:
+            expected = function(expected, element)
+        result = mdl.apply_operation(arr, elements + [2.0], operation, workers=3)
+        assert result.dtype == np.float32
+        assert np.allclose(result, expected)
+    # broadcasting and integer results
+    result = mdl.apply_operation(np.ones((4, 5), np.uint8), [np.arange(5), 1])
+    assert np.array_equal(result, np.arange(5)[None] + 2 * np.ones((4, 1)))
+
+
 def test_divide_value(cube, square):
     assert np.max(mdl.apply_operation(square, 2, operation="divide")) == 0.5
     assert np.min(mdl.apply_operation(square, -2, operation="divide")) == -0.5
+    # operations between values are computed with float64
+    assert mdl.apply_operation(1, 3, "divide") == 1 / 3
+
+
+def test_formula(cube):
+    elements = {"Load_1": cube, "Load_2": cube * 2, "value": 2}
+    result = mdl.apply_formula("( 3 x [Load_1] + 4 x [Load_2] ) ÷ [value]", elements)
+    assert np.array_equal(result, cube * 5.5)
+    # priorities, minus signs and decimal commas
+    assert mdl.apply_formula("1 + 2 x 3 - 4 ÷ 2", {}) == 5
+    assert mdl.apply_formula("10 - 2 - 3", {}) == 5
+    assert mdl.apply_formula("-2 x -(1,5 + 0.5)", {}) == 4
+    # integer images stay integer when the result range allows it
+    result = mdl.apply_formula("255 - [Load_1] x 2", {"Load_1": cube.astype(np.uint8)})
+    assert result.dtype == np.int16
+    assert np.array_equal(result, 255 - cube * 2)
+    with pytest.raises(ValueError):
+        mdl.apply_formula("( [Load_1] + 1", elements)
+    with pytest.raises(ValueError):
+        mdl.apply_formula("[Load_3] + 1", elements)
+
+
+def test_formula_compile():
+    from src.model import calculator
+
+    tree = calculator.compile_formula("[A] x (2 x 3 - 1)")
+    assert tree is calculator.compile_formula("[A] x (2 x 3 - 1)")
+    # constants are folded
+    assert tree == ("multiply", ("constant", 5), ("element", "A"))
+    assert calculator.compile_formula("[A] x (1 ÷ 3)")[1] == ("constant", 1 / 3)
+    # identical subexpressions are shared
+    tree = calculator.compile_formula("[A] x [B] + [B] x [A]")
+    assert tree[1] is tree[2]
+    elements = {"A": np.arange(6).reshape(2, 3), "B": 2}
+    result = mdl.apply_formula("[A] x [B] + [B] x [A]", elements)
+    assert np.array_equal(result, 4 * elements["A"])
+
+
+def test_progress_and_cancel(cube):
+    from src.model import parallel
+
+    arr = np.ones((64, 128, 128))
+    for method, args in [
+        (mdl.apply_operation, (arr, 2)),
+        (mdl.apply_threshold, (arr, 0.5)),
+        (mdl.apply_formula, ("[A] x 2", {"A": arr})),
+        (mdl.apply_basic_morpho, (arr[:, :8, :8], 1, "erosion")),
+    ]:
+        fractions = []
+        method(*args, workers=1, progress=fractions.append)
+        assert len(fractions) > 1 and fractions == sorted(fractions)
+        assert fractions[-1] == 1
+
+        # cancelled after the first block
+        cancel = parallel.CancelToken()
+        with pytest.raises(parallel.Cancelled):
+            method(*args, workers=1, progress=lambda f: cancel.cancel(), cancel=cancel)
+
+    # a cancelled 2d operation does not start
+    cancel = parallel.CancelToken()
+    cancel.cancel()
+    with pytest.raises(parallel.Cancelled):
+        mdl.apply_basic_morpho(cube[0], 1, "dilation", cancel=cancel)
+    cancel.reset()
+    mdl.apply_basic_morpho(cube[0], 1, "dilation", cancel=cancel)
+
+
+def test_cancel_single_file(tmp_path, cube):
+    from src.model import parallel
+
+    # read and written at once, the token is checked after
+    path = str(tmp_path / "cube.npy")
+    cancel = parallel.CancelToken()
+    mdl.save(cube, path, cancel=cancel)
+    cancel.cancel()
+    with pytest.raises(parallel.Cancelled):
+        mdl.load(path, use_cache=False, cancel=cancel)
+    with pytest.raises(parallel.Cancelled):
+        mdl.save(cube, str(tmp_path / "cube.pkl"), cancel=cancel)
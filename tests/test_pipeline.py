@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import pytest
+
+from src.model.model import Model
+from src.pipeline import Pipeline, sort_modules
+
+
+def get_module(module_type, parents=[], **parameters):
+    return {
+        "parameters": parameters,
+        "state": {"moduleType": module_type, "parentNames": parents},
+    }
+
+
+@pytest.fixture
+def settings(tmp_path):
+    return {
+        "Load": get_module(
+            "Load", path=os.path.join(os.getcwd(), "resources/data/Lena.png")
+        ),
+        "GetInfo": get_module("GetInfo", ["Load"], infos="max"),
+        "ThresholdImage": get_module(
+            "ThresholdImage",
+            ["Load"],
+            method="value",
+            reversed=False,
+            inPercentage=False,
+            spin=100,
+        ),
+        "MorphoBasics": get_module(
+            "MorphoBasics",
+            ["ThresholdImage"],
+            erosion=False,
+            dilation=True,
+            opening=False,
+            closing=False,
+            binary=True,
+            size=2,
+        ),
+        "Calculator": get_module(
+            "Calculator", ["Load", "MorphoBasics"], formula="[Load] x [MorphoBasics]"
+        ),
+        "Save": get_module("Save", ["Calculator"], path=str(tmp_path / "result.png")),
+    }
+
+
+def test_sort_modules(settings):
+    order = sort_modules(settings)
+    for name, values in settings.items():
+        for parent in values["state"]["parentNames"]:
+            assert order.index(parent) < order.index(name)
+    settings["Load"]["state"]["parentNames"] = ["Save"]
+    with pytest.raises(ValueError):
+        sort_modules(settings)
+
+
+def test_run_pipeline(settings, tmp_path):
+    results = Pipeline(settings).run()
+    assert not any(isinstance(r, Exception) for r in results.values())
+    assert results["GetInfo"] == np.max(results["Load"])
+    assert np.array_equal(
+        results["Calculator"], results["Load"] * results["MorphoBasics"]
+    )
+    assert os.path.isfile(tmp_path / "result.png")
+
+
+def test_run_subject_memory(settings, tmp_path):
+    from src.model.cache import LOAD_CACHE
+    from src.pipeline import run_subject
+
+    nbytes = LOAD_CACHE.nbytes
+    settings["Save"]["parameters"]["path"] = str(tmp_path / "{subject}_result.png")
+    path = str(tmp_path / "subject.png")
+    Model().save(np.full((32, 32), 200, dtype=np.uint8), path)
+    assert run_subject(settings, ["Load"], path, 0)["status"] == "ok"
+    # inputs are released with the subject
+    assert LOAD_CACHE.nbytes == nbytes
+
+
+def test_run_pipeline_failure(settings):
+    settings["Calculator"]["parameters"]["formula"] = "[Load] x"
+    results = Pipeline(settings).run(["Save"])
+    assert "GetInfo" not in results
+    assert isinstance(results["Calculator"], ValueError)
+    assert isinstance(results["Save"], Exception)
+
+
+def test_run_batch(settings, tmp_path):
+    from src.pipeline import get_inputs, run_batch
+
+    lena = os.path.join(os.getcwd(), "resources/data/Lena.png")
+    inputs = get_inputs([lena, os.path.join(os.getcwd(), "resources/data/lena_*.png")])
+    inputs.append(str(tmp_path / "missing.png"))
+    settings["Save"]["parameters"]["path"] = str(tmp_path / "{subject}_result.png")
+    reports = run_batch(settings, inputs, processes=2)
+    assert [r["input"] for r in reports] == inputs
+    assert [r["status"] for r in reports] == ["ok"] * (len(inputs) - 1) + ["failed"]
+    assert "Load" in reports[-1]["errors"]
+    assert os.path.isfile(tmp_path / "Lena_result.png")
+    assert reports[0]["outputs"] == [str(tmp_path / "Lena_result.png")]